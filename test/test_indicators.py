@@ -0,0 +1,144 @@
+# coding=utf-8
+"""Indicator calculator test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__date__ = '2026-10-15'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import unittest
+
+import numpy as np
+from osgeo import gdal
+
+from utils.indicators import IndicatorCalculator
+
+# As in the plugin (see utils/wapordl_ext.py), failures raise RuntimeError
+gdal.UseExceptions()
+
+
+class SmallBlocksCalculator(IndicatorCalculator):
+    """Few bins and small blocks, so the percentiles need several passes."""
+    MIN_BLOCK_PIXELS = 500
+    PERCENTILE_BINS = 16
+
+
+class BlockPercentilesTest(unittest.TestCase):
+    """Test the exact percentiles by blocks against np.percentile."""
+
+    PERCENTILES = (0, 5, 50, 95, 99, 100)
+
+    def setUp(self):
+        """Runs before each test."""
+        self.calculator = SmallBlocksCalculator('', '')
+        self.rng = np.random.default_rng(0)
+
+    def create_raster(self, arr, nodata=None):
+        """Returns an in-memory Float32 raster with the values of arr."""
+        ds = gdal.GetDriverByName('MEM').Create('', arr.shape[1], arr.shape[0], 1, gdal.GDT_Float32)
+        band = ds.GetRasterBand(1)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        band.WriteArray(arr.astype(np.float32))
+        return ds
+
+    def assertPercentiles(self, arr, valid, nodata=None):
+        """_block_percentiles of arr matches np.percentile of arr[valid]."""
+        ds = self.create_raster(arr, nodata)
+        pcts = self.calculator._block_percentiles(ds, self.PERCENTILES)
+        expected = np.percentile(arr[valid].astype(np.float32).astype(np.float64), self.PERCENTILES)
+        np.testing.assert_allclose(pcts, expected, rtol=1e-6)
+
+    def test_continuous(self):
+        """Distinct values, skewed like an AETI raster."""
+        arr = self.rng.gamma(2.0, 100.0, (97, 103))
+        self.assertPercentiles(arr, np.ones(arr.shape, dtype=bool))
+
+    def test_heavy_ties(self):
+        """A handful of distinct values repeated thousands of times."""
+        arr = self.rng.integers(0, 5, (97, 103)).astype(np.float64)
+        self.assertPercentiles(arr, np.ones(arr.shape, dtype=bool))
+
+    def test_ties_with_outliers(self):
+        """Almost every pixel tied, a few far larger values stretch the range."""
+        arr = np.full((97, 103), 3.0)
+        arr.flat[self.rng.choice(arr.size, 50, replace=False)] = self.rng.uniform(1e3, 1e6, 50)
+        self.assertPercentiles(arr, np.ones(arr.shape, dtype=bool))
+
+    def test_constant(self):
+        """Every pixel has the same value."""
+        arr = np.full((97, 103), 7.25)
+        self.assertPercentiles(arr, np.ones(arr.shape, dtype=bool))
+
+    def test_nodata(self):
+        """The declared no data pixels are left out."""
+        arr = self.rng.gamma(2.0, 100.0, (97, 103))
+        arr[:10] = -9999
+        self.assertPercentiles(arr, arr != -9999, nodata=-9999)
+
+    def test_nan_without_nodata(self):
+        """Without a no data value the negative and NaN pixels are left out."""
+        arr = self.rng.gamma(2.0, 100.0, (97, 103))
+        arr[:10] = np.nan
+        arr[20, :7] = -1
+        self.assertPercentiles(arr, ~np.isnan(arr) & (arr >= 0))
+
+    def test_all_nodata(self):
+        """Every pixel is no data."""
+        ds = self.create_raster(np.full((10, 10), -9999.0), nodata=-9999)
+        pcts = self.calculator._block_percentiles(ds, (95, 99))
+        self.assertTrue(np.isnan(pcts).all())
+
+    def test_nanpercentiles(self):
+        """The single partition percentiles of an array."""
+        vals = self.rng.integers(0, 5, 1001).astype(np.float32)
+        pcts = self.calculator._nanpercentiles(vals, self.PERCENTILES)
+        np.testing.assert_allclose(pcts, np.percentile(vals, self.PERCENTILES), rtol=1e-6)
+
+
+class FakeDataset:
+    """Only the size and the block size of a raster."""
+
+    def __init__(self, block_size, size=(40000, 30000)):
+        self.block_size = block_size
+        self.RasterXSize, self.RasterYSize = size
+
+    def GetRasterBand(self, index):
+        return self
+
+    def GetBlockSize(self):
+        return list(self.block_size)
+
+
+class BlockShapeTest(unittest.TestCase):
+    """Test the windows read together from several rasters."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.calculator = IndicatorCalculator('', '')
+        self.budget = 4 * self.calculator.MIN_BLOCK_PIXELS
+
+    def test_aligned_tiles(self):
+        """Tile sizes multiple of each other share windows of whole tiles."""
+        x, y = self.calculator._block_shape(FakeDataset((256, 256)), FakeDataset((512, 512)))
+        self.assertEqual((x % 512, y % 512), (0, 0))
+        self.assertLessEqual(x * y, self.budget)
+
+    def test_unrelated_tiles(self):
+        """Coprime tiles and tiles mixed with strips stay within the budget."""
+        for other in ((500, 500), (40000, 16)):
+            x, y = self.calculator._block_shape(FakeDataset((256, 256)), FakeDataset(other))
+            self.assertEqual((x % 256, y % 256), (0, 0))
+            self.assertLessEqual(x * y, self.budget)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(BlockPercentilesTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
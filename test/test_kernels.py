@@ -0,0 +1,127 @@
+# coding=utf-8
+"""Kernels test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'waplugin.qgis@gmail.com'
+__date__ = '2026-10-15'
+__copyright__ = 'Copyright 2020, WAP Team'
+
+import unittest
+
+import numpy as np
+
+from utils.kernels import ratio_kernel, linear_kernel, balance_kernel, depleted_kernel, \
+    stats_kernel, merge_stats
+
+
+class KernelsTest(unittest.TestCase):
+    """Test the kernels against NumPy in float64 (with Numba if installed)."""
+
+    DTYPES = (np.int16, np.float32)
+
+    def setUp(self):
+        """Runs before each test."""
+        rng = np.random.default_rng(0)
+        # Close to the Int16 limits, the differences overflow in Int16
+        self.a = rng.integers(-30000, 30000, (37, 53))
+        self.b = rng.integers(-30000, 30000, (37, 53))
+        self.b[::5, ::7] = 0
+        self.b[1, :4] = -10
+
+    def assertKernel(self, out, expected):
+        """The kernels write float32, NaN where the expected value is NaN."""
+        self.assertEqual(out.dtype, np.float32)
+        np.testing.assert_allclose(out, expected, rtol=1e-5, atol=1e-5)
+
+    def test_ratio_kernel(self):
+        """out = num / den * factor, NaN where den is 0."""
+        for dtype in self.DTYPES:
+            a, b = self.a.astype(dtype), self.b.astype(dtype)
+            out = ratio_kernel(a, b, 100.0, np.empty(a.shape, dtype=np.float32))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                expected = np.where(self.b == 0, np.nan, self.a / self.b * 100.0)
+            self.assertKernel(out, expected)
+
+    def test_linear_kernel(self):
+        """out = arr * factor + offset."""
+        for dtype in self.DTYPES:
+            a = self.a.astype(dtype)
+            out = linear_kernel(a, 0.5, 1.0, np.empty(a.shape, dtype=np.float32))
+            self.assertKernel(out, self.a * 0.5 + 1.0)
+
+    def test_balance_kernel(self):
+        """out = 1 - (aeti - pcp) / volume, without Int16 overflow."""
+        for dtype in self.DTYPES:
+            a, b = self.a.astype(dtype), self.b.astype(dtype)
+            out = balance_kernel(a, b, 250.0, np.empty(a.shape, dtype=np.float32))
+            self.assertKernel(out, 1.0 - (self.a - self.b) / 250.0)
+
+    def test_depleted_kernel(self):
+        """out = 1 - aeti / (pcp + volume), NaN where pcp + volume is 0."""
+        for dtype in self.DTYPES:
+            a, b = self.a.astype(dtype), self.b.astype(dtype)
+            out = depleted_kernel(a, b, 10.0, np.empty(a.shape, dtype=np.float32))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                expected = np.where(self.b + 10.0 == 0, np.nan, 1.0 - self.a / (self.b + 10.0))
+            self.assertKernel(out, expected)
+
+    def test_stats_kernel(self):
+        """Count, mean and M2 of the values neither masked nor NaN."""
+        mask = self.a % 3 == 0
+        for dtype in self.DTYPES:
+            arr = self.a.astype(dtype)
+            vals = self.a[~mask]
+            if dtype == np.float32:
+                arr[0, :] = np.nan
+                vals = self.a[~mask & (np.arange(arr.shape[0]) != 0)[:, None]]
+            n, mean, m2 = stats_kernel(arr, mask)
+            self.assertEqual(n, vals.size)
+            self.assertAlmostEqual(mean, vals.mean(), delta=1e-9 * abs(vals.mean()) + 1e-9)
+            np.testing.assert_allclose(np.sqrt(m2 / n), vals.std(), rtol=1e-9)
+
+    def test_stats_kernel_empty(self):
+        """Every value masked."""
+        arr = self.a.astype(np.float32)
+        n, mean, m2 = stats_kernel(arr, np.ones(arr.shape, dtype=bool))
+        self.assertEqual((n, mean, m2), (0, 0.0, 0.0))
+
+    def test_merge_stats(self):
+        """Chan's merge of uneven (and empty) chunks against np.std."""
+        rng = np.random.default_rng(1)
+        # A small spread next to a large mean, the sum of squares formula
+        # loses every significant digit here
+        vals = 1e4 + rng.standard_normal(10007) * 0.01
+        acc = (0, 0.0, 0.0)
+        for chunk in np.split(vals, [0, 1, 17, 17, 4000, 9999]):
+            dev = chunk - chunk.mean() if chunk.size else chunk
+            acc = merge_stats(*acc, chunk.size, chunk.mean() if chunk.size else 0.0, float(dev @ dev))
+        n, mean, m2 = acc
+        self.assertEqual(n, vals.size)
+        np.testing.assert_allclose(mean, vals.mean(), rtol=1e-12)
+        np.testing.assert_allclose(np.sqrt(m2 / n), vals.std(), rtol=1e-9)
+
+    def test_merge_stats_blocks(self):
+        """stats_kernel blocks merged as in IndicatorCalculator._block_stats."""
+        arr = (1e4 + np.random.default_rng(2).standard_normal((300, 200)) * 0.01).astype(np.float32)
+        mask = np.zeros(arr.shape, dtype=bool)
+        mask[:5] = True
+        acc = (0, 0.0, 0.0)
+        for row in range(0, arr.shape[0], 70):
+            acc = merge_stats(*acc, *stats_kernel(arr[row:row + 70], mask[row:row + 70]))
+        vals = arr[~mask].astype(np.float64)
+        n, mean, m2 = acc
+        self.assertEqual(n, vals.size)
+        np.testing.assert_allclose(mean, vals.mean(), rtol=1e-12)
+        np.testing.assert_allclose(np.sqrt(m2 / n), vals.std(), rtol=1e-6)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(KernelsTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
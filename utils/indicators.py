@@ -14,11 +14,57 @@
 import numpy as np
 from osgeo import gdal
 import os
-
-from qgis.analysis import QgsRasterCalculatorEntry, QgsRasterCalculator
-from qgis.core import QgsRasterLayer
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+import json
+import math
+from collections import namedtuple
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+from .kernels import ratio_kernel, linear_kernel, balance_kernel, depleted_kernel, stats_kernel, \
+    merge_stats
+
+try:
+    import dask
+    use_dask = True
+except ImportError:
+    print("Consider installing `dask` to compute several indicators in parallel.")
+    use_dask = False
+
+try:
+    import numexpr as ne
+    ne.set_num_threads(os.cpu_count())
+    use_numexpr = True
+except ImportError:
+    print("Consider installing `numexpr` for faster indicator computations.")
+    use_numexpr = False
 
 from qgis.PyQt.QtWidgets import QMessageBox
+from qgis.core import QgsMessageLog, Qgis
+
+# Set the WAP_DEBUG environment variable to get the debug messages in the
+# QGIS log messages panel (see _QgsLogHandler)
+log = logging.getLogger(__name__)
+
+class _QgsLogHandler(logging.Handler):
+    """
+        Forwards the log records to the WAPlugin tab of the QGIS log
+        messages panel, Python's default handler drops those below WARNING.
+    """
+    def emit(self, record):
+        if record.levelno >= logging.ERROR:
+            level = Qgis.Critical
+        elif record.levelno >= logging.WARNING:
+            level = Qgis.Warning
+        else:
+            level = Qgis.Info
+        try:
+            QgsMessageLog.logMessage(self.format(record), 'WAPlugin', level)
+        except Exception:
+            self.handleError(record)
 
 
 """
@@ -51,186 +97,296 @@ from qgis.PyQt.QtWidgets import QMessageBox
         }
 """
 
-INDICATORS_INFO = {
-                    'Uniformity of Water Consumption' : {
-                        'info' : 'Equity is defined as the coefficients of variation (CV) of seasonal ETa in the area of interest.  \
-                                  equity = (sd_raster / mean_raster) * 100',
-                        'rasters' : {
-                            'AETI' : 'Actual Evapotranspiration and Interception'
-                        },
-                        'factors' : {
-                            'sd_raster' : 'Standard deviation obtained from the Raster',
-                            'mean_raster' : 'Mean obtained from the Raster'
-                        },
-                        'params' : {
-                            'PARAM_1' : {'label':'AETI', 'type': ['AETI']},
-                            'PARAM_2' : '',
-                            'PARAM_3' : ''
-                        }
-                    },
-                    'Beneficial Fraction' : {
-                        'info' : 'BF = (T / AETI)',
-                        'rasters' : {
-                            'AETI' : 'Actual Evapotranspiration and Interception',
-                            'T' : 'Transpiration'
-                        },
-                        'factors' : {
-                            # 'Conversion Factor' : '0.1'
-                        },
-                        'params' : {
-                            'PARAM_1' : {'label':'T Raster', 'type': ['T']},
-                            'PARAM_2' : {'label':'AETI Raster', 'type': ['AETI']},
-                            'PARAM_3' : ''
-                        }
-                    },
-                    'Adequacy (Relative Evapotranspiration)' : {
-                        'info' : 'AD = (ETa / ETp)',
-                        'rasters' : {
-                            'ETa' : 'Actual Evapotranspiration and Interception',
-                            'ETp' : '95th percentile of AETI '
-                        },
-                        'factors' : {
-                            # 'Kc' : 'A constant to compute Potential Evapotranspiration'
-                        },
-                        'params' : {
-                            'PARAM_1' : {'label':'AETI Raster', 'type': ['AETI']},
-                            'PARAM_2' : '',
-                            'PARAM_3' : ''
-                        }
-                    },
-                    'Relative Water Deficit' : {
-                        'info' : 'RWD = 1 - (AETI / ETx)',
-                        'rasters' : {
-                            'AETI' : 'Actual Evapotranspiration and Interception'
-                        },
-                        'factors' : {
-                            'ETx' : '99 percentile of the Raster'
-                        },
-                        'params' : {
-                            'PARAM_1' : {'label':'AETI Raster', 'type': ['AETI']},
-                            'PARAM_2' : '',
-                            'PARAM_3' : ''
-                        }
-                    },
-                    'Total Biomass Production' : {
-                        'info' : """Net Primary Production can be used to estimate total biomass production using the following formula:  \n TBP = (NPP * 22.22)/1000 
-                        \n The value 22.222 is to convert the NPP in gC/m^2 to biomass production in kg/ha. To convert to ton/ha the value is divided by 1000.""",
-                        'rasters' : {
-                            'NPP' : 'Net Primary Production'
-                        },
-                        'factors' : {
-                        },
-                        'params' : {
-                            'PARAM_1' : {'label':'NPP Raster', 'type': ['NPP']},
-                            'PARAM_2' : '',
-                            'PARAM_3' : ''
-                        }
-                    },
-                    'Biomass Water Productivity' : {
-                        'info' : """It is defined as the total biomass production divided by the AETI:  \n WPb = TBP/AETI * 100
-                        \n The multiplication with 100 is needed to correct the units, first convert TBP in ton/ha to kg/m^2 (divide by 10) and then AETI from mm/season to m/season (divide by 1000) so that the final unit of WPb is kg/m^3.""",
-                        'rasters' : {
-                            'AETI' : 'Actual Evapotranspiration and Interception',
-                            'TBP' : 'Total Biomass Productionn'
-                        },
-                        'factors' : {
-                        },
-                        'params' : {
-                            'PARAM_1' : {'label':'AETI Raster', 'type': ['AETI']},
-                            'PARAM_2' : {'label':'TBP Raster', 'type': ['TBP']},
-                            'PARAM_3' : ''
-                        }
-                    },
-                    'Yield' : {
-                        'info' : """Yield Y = HI * AOT * fc * (TBP / (1 - MC)) \n MC: moisture content, dry matter over fresh biomass \n fc: Light use efficiency correction factor \n AOT: above ground over total biomass production ratio(AOT) \n HI: Harvest Index""",
-                        'rasters' : {
-                            'TBP' : 'Total Biomass Productionn'
-                        },
-                        'factors' : {
-                        },
-                        'params' : {
-                            'PARAM_1' : {'label':'TBP Raster', 'type': ['TBP']},
-                            'PARAM_2' : '',
-                            'PARAM_3' : ['MC', 'fc', 'AOT', 'HI']
-                        }
-                    },
-                    'Crop Water Productivity' : {
-                        'info' : """It is defined as the yield divided by the AETI:  \n cWP = Y/AETI * 100
-                        \n The multiplication with 100 is to correct the units to kg/m3 (from AETI in mm/season and TBP in ton/ha) .""",
-                        'rasters' : {
-                            'Y' : 'Yield',
-                            'AETI' : 'Actual Evapotranspiration and Interception'
-                        },
-                        'factors' : {
-                        },
-                        'params' : {
-                            'PARAM_1' : {'label':'Y Raster', 'type': ['Y']},
-                            'PARAM_2' : {'label':'AETI Raster', 'type': ['AETI']},
-                            'PARAM_3' : ''
-                        }
-                    },
-                    # """ Below indicators are commented out because they still have to be validated """
-                    # 'Overall Consumed Ratio' : {
-                    #     'info' : 'OCR = (AETI - PCP) / V_ws',
-                    #     'rasters' : {
-                    #         'AETI' : 'Actual Evapotranspiration and Interception',
-                    #         'PCP' : 'Precipitation'
-                    #     },
-                    #     'factors' : {
-                    #         'V_ws' : 'Volume of water supplied to command area in mm.'
-                    #     },
-                    #     'params' : {
-                    #         'PARAM_1' : {'label':'AETI Raster', 'type': ['AETI']},
-                    #         'PARAM_2' : {'label':'PCP Raster', 'type': ['PCP']},
-                    #         'PARAM_3' : 'V_ws'
-                    #     }
-                    # },
-                    # 'Field Application Ratio (efficiency)' : {
-                    #     'info' : 'FAR = (AETI - PCP) / V_wd',
-                    #     'rasters' : {
-                    #         'AETI' : 'Actual Evapotranspiration and Interception',
-                    #         'PCP' : 'Precipitation'
-                    #     },
-                    #     'factors' : {
-                    #         'V_wd' : 'Volume of water delivered to field(s) in mm.'
-                    #     },
-                    #     'params' : {
-                    #         'PARAM_1' : {'label':'AETI Raster', 'type': ['AETI']},
-                    #         'PARAM_2' : {'label':'PCP Raster', 'type': ['PCP']},
-                    #         'PARAM_3' : 'V_wd'
-                    #     }
-                    # },
-                    # 'Depleted Fraction' : {
-                    #     'info' : 'DF = 1 - AETI / (PCP + V_c)',
-                    #     'rasters' : {
-                    #         'AETI' : 'Actual Evapotranspiration and Interception',
-                    #         'PCP' : 'Precipitation'
-                    #     },
-                    #     'factors' : {
-                    #         'V_c' : 'Volume of water consumed in mm.'
-                    #     },
-                    #     'params' : {
-                    #         'PARAM_1' : {'label':'AETI Raster', 'type': ['AETI']},
-                    #         'PARAM_2' : {'label':'PCP Raster', 'type': ['PCP']},
-                    #         'PARAM_3' : 'V_c'
-                    #     }
-                    # }
-                  }
+"""
+    The definitions are stored in indicators.json next to this module, they are
+    only parsed the first time an indicator is looked up.
+"""
+_INDICATORS_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'indicators.json')
+
+class _LazyDict(Mapping):
+    """
+        Read-only mapping whose content is built by `loader` on first access.
+    """
+    def __init__(self, loader):
+        self._loader = loader
+        self._data = None
+
+    def _get_data(self):
+        if self._data is None:
+            self._data = self._loader()
+        return self._data
+
+    def __getitem__(self, key):
+        return self._get_data()[key]
+
+    def __iter__(self):
+        return iter(self._get_data())
+
+    def __len__(self):
+        return len(self._get_data())
+
+def _load_indicators_info():
+    with open(_INDICATORS_JSON, encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+INDICATORS_INFO = _LazyDict(_load_indicators_info)
+
+# """ Below indicators are not in indicators.json because they still have to be validated """
+# 'Overall Consumed Ratio' : {
+#     'info' : 'OCR = (AETI - PCP) / V_ws',
+#     'rasters' : {
+#         'AETI' : 'Actual Evapotranspiration and Interception',
+#         'PCP' : 'Precipitation'
+#     },
+#     'factors' : {
+#         'V_ws' : 'Volume of water supplied to command area in mm.'
+#     },
+#     'params' : {
+#         'PARAM_1' : {'label':'AETI Raster', 'type': ['AETI']},
+#         'PARAM_2' : {'label':'PCP Raster', 'type': ['PCP']},
+#         'PARAM_3' : 'V_ws'
+#     }
+# },
+# 'Field Application Ratio (efficiency)' : {
+#     'info' : 'FAR = (AETI - PCP) / V_wd',
+#     'rasters' : {
+#         'AETI' : 'Actual Evapotranspiration and Interception',
+#         'PCP' : 'Precipitation'
+#     },
+#     'factors' : {
+#         'V_wd' : 'Volume of water delivered to field(s) in mm.'
+#     },
+#     'params' : {
+#         'PARAM_1' : {'label':'AETI Raster', 'type': ['AETI']},
+#         'PARAM_2' : {'label':'PCP Raster', 'type': ['PCP']},
+#         'PARAM_3' : 'V_wd'
+#     }
+# },
+# 'Depleted Fraction' : {
+#     'info' : 'DF = 1 - AETI / (PCP + V_c)',
+#     'rasters' : {
+#         'AETI' : 'Actual Evapotranspiration and Interception',
+#         'PCP' : 'Precipitation'
+#     },
+#     'factors' : {
+#         'V_c' : 'Volume of water consumed in mm.'
+#     },
+#     'params' : {
+#         'PARAM_1' : {'label':'AETI Raster', 'type': ['AETI']},
+#         'PARAM_2' : {'label':'PCP Raster', 'type': ['PCP']},
+#         'PARAM_3' : 'V_c'
+#     }
+# }
+
+
+"""
+    INDICATORS_INFO flattened once, on first access, into immutable tuples,
+    this is what the UI reads:
+        INDICATORS['<NAME_INDICATOR>'].rasters    -> (('<CODE_RASTER_1>', '<NAME_RASTER_1>'), ...)
+        INDICATORS['<NAME_INDICATOR>'].factors    -> (('FACTOR_1', 'DESCRIPTION_FACTOR_1'), ...)
+        INDICATORS['<NAME_INDICATOR>'].params[0]  -> IndicatorParam(label, type) or None
+        INDICATORS['<NAME_INDICATOR>'].params[2]  -> ('MC', 'fc', ...) or ()
+"""
+IndicatorSpec = namedtuple('IndicatorSpec', ['info', 'rasters', 'factors', 'params'])
+IndicatorParam = namedtuple('IndicatorParam', ['label', 'type'])
+
+def _to_spec(indicator_info):
+    params = indicator_info['params']
+    raster_params = tuple(IndicatorParam(params[key]['label'], tuple(params[key]['type'])) if params[key] else None
+                          for key in ('PARAM_1', 'PARAM_2'))
+    other_params = params['PARAM_3']
+    if isinstance(other_params, str):
+        other_params = (other_params,) if other_params else ()
+    return IndicatorSpec(indicator_info['info'],
+                         tuple(indicator_info['rasters'].items()),
+                         tuple(indicator_info['factors'].items()),
+                         raster_params + (tuple(other_params),))
+
+INDICATORS = _LazyDict(lambda: {name: _to_spec(indicator_info) for name, indicator_info in INDICATORS_INFO.items()})
+
+# Uniformity classes of the coefficient of variation: below 10 is good,
+# from 10 to 25 is fair and 25 or above is poor
+_UNIFORMITY_BINS = np.array([10.0, 25.0])
+_UNIFORMITY_LABELS = np.array(['Good Uniformity', 'Fair Uniformity', 'Poor Uniformity'])
+
+"""
+    Per-pixel formulas of the indicators computed by _run_formula, keyed by the
+    name of the IndicatorCalculator method:
+        expression  -> numexpr expression, NaN is the no data value
+        inputs      -> names in the expression, the rasters first (in the order
+                       they are read) followed by the factors
+        kernel      -> the same formula from .kernels, used without numexpr,
+                       called with the raster blocks and the factors
+"""
+Formula = namedtuple('Formula', ['expression', 'inputs', 'kernel'])
+
+def _empty_out(arr):
+    # The blocks may be read as integers (see _read_block), the outputs are float32
+    return np.empty(arr.shape, dtype=np.float32)
+
+_FORMULAS = {
+    'beneficial_fraction': Formula(
+        'where(AETI == 0, NaN, TA / AETI)', ('AETI', 'TA', 'NaN'),
+        lambda AETI, TA: ratio_kernel(TA, AETI, 1.0, _empty_out(TA))),
+    'adequacy': Formula(
+        'AETI / ETp', ('AETI', 'ETp'),
+        lambda AETI, ETp: linear_kernel(AETI, 1.0 / ETp, 0.0, _empty_out(AETI))),
+    'relative_water_deficit': Formula(
+        '1 - AETI / ETx', ('AETI', 'ETx'),
+        lambda AETI, ETx: linear_kernel(AETI, -1.0 / ETx, 1.0, _empty_out(AETI))),
+    'total_biomass_production': Formula(
+        'NPP * factor', ('NPP', 'factor'),
+        lambda NPP, factor: linear_kernel(NPP, factor, 0.0, _empty_out(NPP))),
+    'biomass_water_productivity': Formula(
+        'where(AETI == 0, NaN, TBP / AETI * 100)', ('AETI', 'TBP', 'NaN'),
+        lambda AETI, TBP: ratio_kernel(TBP, AETI, 100.0, _empty_out(TBP))),
+    'yield_indicator': Formula(
+        'TBP * factor', ('TBP', 'factor'),
+        lambda TBP, factor: linear_kernel(TBP, factor, 0.0, _empty_out(TBP))),
+    'crop_water_productivity': Formula(
+        'where(AETI == 0, NaN, Y / AETI * 100)', ('AETI', 'Y', 'NaN'),
+        lambda AETI, Y: ratio_kernel(Y, AETI, 100.0, _empty_out(Y))),
+    'overall_consumed_ratio': Formula(
+        '1 - (AETI - PCP) / V_ws', ('AETI', 'PCP', 'V_ws'),
+        lambda AETI, PCP, V_ws: balance_kernel(AETI, PCP, V_ws, _empty_out(AETI))),
+    'field_application_ratio': Formula(
+        '1 - (AETI - PCP) / V_wd', ('AETI', 'PCP', 'V_wd'),
+        lambda AETI, PCP, V_wd: balance_kernel(AETI, PCP, V_wd, _empty_out(AETI))),
+    'depleted_fraction': Formula(
+        'where(PCP + V_c == 0, NaN, 1 - AETI / (PCP + V_c))', ('AETI', 'PCP', 'V_c', 'NaN'),
+        lambda AETI, PCP, V_c: depleted_kernel(AETI, PCP, V_c, _empty_out(AETI))),
+}
+
+# Band types read as they are by the block kernels, see IndicatorCalculator._read_block
+_NATIVE_DTYPES = {gdal.GDT_Byte: np.dtype(np.uint8),
+                  gdal.GDT_Int16: np.dtype(np.int16),
+                  gdal.GDT_UInt16: np.dtype(np.uint16)}
+
+# Formulas whose values are fractions, see IndicatorCalculator.FRACTION_SCALE
+_FRACTION_FORMULAS = {'beneficial_fraction', 'adequacy', 'relative_water_deficit',
+                      'overall_consumed_ratio', 'field_application_ratio', 'depleted_fraction'}
+
+@lru_cache(maxsize=None)
+def _compile_formula(expression, inputs):
+    """
+        Compiles a formula once, every input is float32 (numexpr's `float`
+        kind) so are the intermediate values and the result.
+    """
+    return ne.NumExpr(expression, signature=[(name, float) for name in inputs])
+
+@lru_cache(maxsize=16)
+def _formula_kernel(name, dtypes, factor_names):
+    """
+        Returns the kernel of the formula name for raster blocks of dtypes,
+        called once on 1 x 1 arrays so Numba compiles (or loads from its
+        cache) that specialization now instead of on the first block. Numba
+        specializes on the argument types only, the shape is not part of the key.
+    """
+    kernel = _FORMULAS[name].kernel
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kernel(*[np.ones((1, 1), dtype=dtype) for dtype in dtypes],
+               **{key: 1.0 for key in factor_names})
+    return kernel
+
+@lru_cache(maxsize=256)
+def _resolve_raster_path(rasters_dir, name, memory_prefix):
+    """
+        Path of the raster name of rasters_dir, see IndicatorCalculator._raster_path.
+    """
+    if name.startswith(memory_prefix):
+        return '/vsimem/' + name[len(memory_prefix):]
+    return os.path.join(rasters_dir, name)
+
+def _closes_rasters(method):
+    """
+        Closes the rasters opened by an IndicatorCalculator method once the
+        outermost call returns (e.g. run_batch and the indicators it runs),
+        so the plugin does not keep the user's files open between calculations
+        (Windows does not allow replacing an open file).
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._cache_guard:
+            self._active_calls += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            with self._cache_guard:
+                self._active_calls -= 1
+                if self._active_calls == 0:
+                    self._handles.clear()
+    return wrapper
+
+class _LabelBuffer:
+    """
+        Stands for a QLabel while an indicator runs outside the GUI thread,
+        keeping the last text set so it can be copied to the real label.
+    """
+    def __init__(self):
+        self.text = None
+
+    def setText(self, text):
+        self.text = text
+
 
 class IndicatorCalculator:
+    # Minimum number of pixels read at once when processing rasters by blocks
+    MIN_BLOCK_PIXELS = 1 << 20
+    # Minimum number of pixels of the overview used for approximate percentiles
+    APPROX_MIN_PIXELS = 1 << 22
+    # Number of bins of the histograms used for exact percentiles by blocks
+    PERCENTILE_BINS = 1 << 16
+    # Size of the tiles of the output rasters, their overviews stop at one tile
+    OUTPUT_BLOCK_SIZE = 512
+    # Scale of the outputs of the fraction indicators (BF, AD, RWD, OCR, FAR,
+    # DF), e.g. 10000 writes them as Int16 with a 0.0001 scale factor instead
+    # of Float32. None keeps Float32
+    FRACTION_SCALE = None
+    INT16_NODATA = -32768
+    # Prefix of the names of the rasters kept in memory (see _raster_path)
+    MEMORY_PREFIX = 'mem://'
+    # Metadata item recording the resampling of the overviews built by the plugin
+    OVERVIEW_RESAMPLING_KEY = 'WAP_OVERVIEW_RESAMPLING'
+    # GDAL settings for reading large tiled rasters, applied only while the
+    # plugin opens its own rasters (see _gdal_options), values already set by
+    # the user (environment or QGIS options) are kept
+    GDAL_CONFIG = {
+        'GDAL_NUM_THREADS': 'ALL_CPUS',
+        # Do not list the rasters directory on every gdal.Open, the sidecar
+        # files (.ovr, .aux.xml) are still probed one by one
+        'GDAL_DISABLE_READDIR_ON_OPEN': 'TRUE',
+        # Remote (/vsicurl/) rasters: only probe the files GDAL may need and cache them
+        'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif,.tiff,.ovr',
+        'VSI_CACHE': 'TRUE',
+    }
+
     def __init__(self, plugin_dir, rasters_path):
         self.plugin_dir = plugin_dir
         self.rasters_dir = os.path.join(self.plugin_dir, rasters_path)
 
+        if os.environ.get('WAP_DEBUG'):
+            log.setLevel(logging.DEBUG)
+            if not any(isinstance(handler, _QgsLogHandler) for handler in log.handlers):
+                log.addHandler(_QgsLogHandler())
+
+        self._output_locks = {}
+        self._locks_guard = threading.Lock()
+        # Open rasters (see _open) and AETI summaries (see aeti_summary)
+        self._handles = {}
+        self._summaries = {}
+        self._cache_guard = threading.Lock()
+        self._active_calls = 0
+
     def setRastersDir(self, newPath):
         self.rasters_dir = os.path.join(self.plugin_dir, newPath)
 
     def showErrorMsg(self, msg):
-        print("The internet connection is down")
+        log.debug('Calculation error: %s', msg)
         QMessageBox.information(None, "Calculation error", '''<html><head/><body>
         <p>{}.</p></body></html>'''.format(msg))
 
-    def equity(self, raster, outLabel):
+    @_closes_rasters
+    def equity(self, raster, outLabel, approximate=False):
         """
         [FORMULA PASSED THE TEST WITH TRUE VALUES]
         Equity is computed from the formula:
@@ -247,34 +403,140 @@ class IndicatorCalculator:
                         --- Conversion Factor: AETI - 0.1, PE - 0.01
                 --- 0.1 - (real number) - Unit conversion factor because the rasters are in different unit from Wapor
 
+        The statistics are computed exactly by blocks, with approximate=True
+        they are estimated by GDAL from the overviews.
+
         Output:
         --- equity - real number
         """
-        ras_atei_dir = os.path.join(self.rasters_dir, raster)
-        print('test equity')
-        print(self.rasters_dir)
-        print(ras_atei_dir)
-        print(raster)
-        ds = gdal.Open(ras_atei_dir)
-
-        atei_band1 = self._get_array(ds)
-
-        AETIm   = np.nanmean(atei_band1)
-        AETIsd  = np.nanstd(atei_band1)
+        ras_atei_dir = self._raster_path(raster)
+        log.debug('Equity of %s', ras_atei_dir)
+        if approximate:
+            AETIm, AETIsd = self._band_stats(self._open(ras_atei_dir), True)
+        else:
+            AETIm, AETIsd = self._block_stats(self._open(ras_atei_dir))
 
         equity = (AETIsd / AETIm) * 100
 
-        if equity < 10:
-            U = 'Good Uniformity'
-        elif 10 <= equity < 25:
-            U = 'Fair Uniformity'
-        else:
-            U = 'Poor Uniformity'
+        U = _UNIFORMITY_LABELS[np.searchsorted(_UNIFORMITY_BINS, equity, side='right')]
 
-        print('Uniformity in this region is =', round(equity, 1), ',', U)
-        # print("Equity for the given Raster is: ", equity)
+        log.debug('Uniformity in this region is = %.1f, %s', equity, U)
         outLabel.setText('Uniformity in this region is = {}, {}   '.format(round(equity, 1), U))
 
+    @_closes_rasters
+    def equity_series(self, rasters):
+        """
+        Computes the equity and uniformity class of several rasters of the
+        same grid at once, e.g. the dekadal AETI of a season. The rasters are
+        read window by window into one preallocated (N, rows, columns) buffer,
+        so the statistics of all of them are computed by vectorized reductions
+        per window (merged across windows as in merge_stats), and the classes
+        by a single np.searchsorted.
+
+        Raises ValueError when the rasters have different sizes.
+
+        Output:
+        --- list of (equity - real number, uniformity - text), one per raster
+        """
+        datasets = [self._open(self._raster_path(raster)) for raster in rasters]
+        if not datasets:
+            return []
+        if not self._same_size(*datasets):
+            raise ValueError('The rasters have different sizes')
+
+        block_x, block_y = self._block_shape(*datasets)
+        buf = np.empty((len(datasets), block_y, block_x), dtype=np.float32)
+        mask = np.empty(buf.shape, dtype=bool)
+
+        n = np.zeros(len(datasets), dtype=np.int64)
+        mean = np.zeros(len(datasets))
+        m2 = np.zeros(len(datasets))
+        for xoff, yoff, xsize, ysize in self._iter_windows(*datasets):
+            win_buf = buf[:, :ysize, :xsize]
+            win_mask = mask[:, :ysize, :xsize]
+            for i, ds in enumerate(datasets):
+                band = ds.GetRasterBand(1)
+                band.ReadAsArray(xoff, yoff, xsize, ysize, buf_obj=win_buf[i])
+                win_mask[i] = self._nodata_mask(band, win_buf[i])
+
+            win_buf[win_mask] = 0.0
+            win_n = (~win_mask).sum(axis=(1, 2))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                win_mean = np.nan_to_num(win_buf.sum(axis=(1, 2), dtype=np.float64) / win_n)
+            # Deviations from the window means, the no data pixels contribute 0
+            dev = win_buf - win_mean[:, None, None].astype(np.float32)
+            dev[win_mask] = 0.0
+            win_m2 = np.einsum('kij,kij->k', dev, dev, dtype=np.float64)
+
+            total = n + win_n
+            with np.errstate(invalid='ignore', divide='ignore'):
+                weight = np.nan_to_num(win_n / total)
+            delta = win_mean - mean
+            mean += delta * weight
+            m2 += win_m2 + delta * delta * n * weight
+            n = total
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean[n == 0] = np.nan
+            std = np.sqrt(m2 / n)
+            equity = std / mean * 100
+
+        U = _UNIFORMITY_LABELS[np.searchsorted(_UNIFORMITY_BINS, equity, side='right')]
+        return list(zip(equity.tolist(), U.tolist()))
+
+    @_closes_rasters
+    def equity_map(self, raster, output_name, window=5):
+        """
+        Classifies the uniformity of every pixel with the coefficient of
+        variation of the AETI in the window x window pixels around it:
+            --- CV = (sd_window / mean_window) * 100
+            --- Classes: 1 - Good (CV < 10), 2 - Fair (10 <= CV < 25), 3 - Poor
+        The window sums are computed for the whole raster at once with summed
+        area tables and the classes with a single np.searchsorted.
+
+        Raises ValueError when window is not a positive odd number, the window
+        has to be centred on the pixel.
+
+        Output:
+        --- Uniformity classes - Byte raster, 0 is no data
+        """
+        if window < 1 or window % 2 == 0:
+            raise ValueError('The window must be a positive odd number of pixels')
+
+        ras_atei_dir = self._raster_path(raster)
+        output_dir = self._raster_path(output_name)
+
+        ds, atei_band1, nodata_mask = self._load_array(ras_atei_dir)
+
+        valid = ~nodata_mask
+        vals = np.where(valid, atei_band1, 0).astype(np.float64)
+
+        n = self._window_sum(valid.astype(np.float64), window)
+        s = self._window_sum(vals, window)
+        ss = self._window_sum(vals * vals, window)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = s / n
+            std = np.sqrt(np.maximum(ss / n - mean * mean, 0.0))
+            cv = std / mean * 100
+
+        classes = (np.searchsorted(_UNIFORMITY_BINS, cv, side='right') + 1).astype(np.uint8)
+        classes[~valid | np.isnan(cv)] = 0
+
+        self._write_array(classes, ds, output_dir, gdal.GDT_Byte, 0)
+
+    def _window_sum(self, arr, window):
+        """
+        Sums arr over a window x window neighbourhood of every pixel using a
+        summed area table, the borders are padded with zeros.
+        """
+        pad = window // 2
+        table = np.pad(arr, pad).cumsum(axis=0).cumsum(axis=1)
+        table = np.pad(table, ((1, 0), (1, 0)))
+        return (table[window:, window:] - table[:-window, window:]
+                - table[window:, :-window] + table[:-window, :-window])
+
+    @_closes_rasters
     def beneficial_fraction(self, ta_dir, aeti_dir, output_name):
         """
         Beneficial fraction is computed from the formula:
@@ -292,37 +554,10 @@ class IndicatorCalculator:
         Output:
         --- BF - Raster
         """
-        ras_atei_dir = os.path.join(self.rasters_dir, aeti_dir)
-        ras_ta_dir = os.path.join(self.rasters_dir, ta_dir)
-        output_dir = os.path.join(self.rasters_dir, output_name)
-
-        ras_atei = QgsRasterLayer(ras_atei_dir)
-        ras_ta = QgsRasterLayer(ras_ta_dir)
-
-        entries = []
-
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@1'
-        ras.raster = ras_atei
-        ras.bandNumber = 1
-        entries.append(ras)
+        self._run_formula('beneficial_fraction', [aeti_dir, ta_dir], output_name)
 
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@2'
-        ras.raster = ras_ta
-        ras.bandNumber = 1
-        entries.append(ras)
-
-        calc = QgsRasterCalculator('ras@2 / ras@1',
-                                    output_dir,
-                                    'GTiff',
-                                    ras_atei.extent(),
-                                    ras_atei.width(),
-                                    ras_atei.height(),
-                                    entries)
-        print(calc.processCalculation())
-
-    def adequacy(self, aeti_dir, output_name):
+    @_closes_rasters
+    def adequacy(self, aeti_dir, output_name, approximate=True):
         """
         [FORMULA PASSED THE TEST WITH TRUE VALUES]
         Adequacy is computed from the formula:
@@ -334,44 +569,24 @@ class IndicatorCalculator:
             -- ETp - (raster) - 95th percentile of AETI 
         --- Units: decimal or percentage(*100)
 
+        With approximate=True the percentile comes from aeti_summary,
+        otherwise it is computed exactly (see _block_percentiles).
+
         Output:
         --- AD - Raster
         """
-        ras_atei_dir = os.path.join(self.rasters_dir, aeti_dir)
-        output_dir = os.path.join(self.rasters_dir, output_name)
-
-        ras_atei = QgsRasterLayer(ras_atei_dir)
-
-        ds = gdal.Open(ras_atei_dir)
-
-        atei_band1 = self._get_array(ds)
-
-        AETI1_1D  = np.reshape(atei_band1,  atei_band1.shape[0] * atei_band1.shape[1])
-
-        ETp = np.nanpercentile(AETI1_1D, 99)
-        # ETp_value = np.nanpercentile(atei_band1, 95)
-        # ETp = np.full_like(atei_band1, ETp_value)
-        # ETp  = np.reshape(ETp,  atei_band1.shape[0] * atei_band1.shape[1])
-
-        entries = []
+        ras_atei_dir = self._raster_path(aeti_dir)
 
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@1'
-        ras.raster = ras_atei
-        ras.bandNumber = 1
-        entries.append(ras)
+        if approximate:
+            _, _, _, ETp = self.aeti_summary(ras_atei_dir)
+        else:
+            ETp, = self._block_percentiles(self._open(ras_atei_dir), (99,))
 
-        calc = QgsRasterCalculator('(ras@1) / {}'.format(ETp),
-                                    output_dir,
-                                    'GTiff',
-                                    ras_atei.extent(),
-                                    ras_atei.width(),
-                                    ras_atei.height(),
-                                    entries)
-        print(calc.processCalculation())
+        self._run_formula('adequacy', [aeti_dir], output_name, {'ETp': ETp}, stats=False)
 
 
-    def relative_water_deficit(self, aeti_dir, output_name, outLabel):
+    @_closes_rasters
+    def relative_water_deficit(self, aeti_dir, output_name, outLabel, approximate=True):
         """
         [FORMULA PASSED THE TEST WITH TRUE VALUES]
         Relative water deficit is computed from the formula:
@@ -387,49 +602,36 @@ class IndicatorCalculator:
                 --- Conversion Factor: 0.1
         --- Units: decimal or percentage(*100)
 
+        With approximate=True the mean and the percentile come from
+        aeti_summary, otherwise they are computed exactly by blocks (see
+        _block_percentiles), without building overviews.
+
         Output:
         --- RWD - Raster
         """
-        ras_atei_dir = os.path.join(self.rasters_dir, aeti_dir)
-        output_dir = os.path.join(self.rasters_dir, output_name)
-        ras_atei = QgsRasterLayer(ras_atei_dir)
-
-        ds = gdal.Open(ras_atei_dir)
-
-        atei_band1 = self._get_array(ds)
+        ras_atei_dir = self._raster_path(aeti_dir)
 
-        AETI1_1D  = np.reshape(atei_band1,  atei_band1.shape[0] * atei_band1.shape[1])
-        ETx = np.nanpercentile(AETI1_1D, 95)
-
-        AETI_mean = np.nanmean(atei_band1)
+        if approximate:
+            AETI_mean, _, ETx, _ = self.aeti_summary(ras_atei_dir)
+        else:
+            ds = self._open(ras_atei_dir)
+            AETI_mean, _ = self._block_stats(ds)
+            ETx, = self._block_percentiles(ds, (95,))
 
         RWD = 1 - (AETI_mean / ETx)
         outLabel.setText('Relative water deficit = {}'.format(round(RWD, 2)))
 
-        print(ETx)
+        log.debug('ETx of %s = %s', aeti_dir, ETx)
 
-        entries = []
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@1'
-        ras.raster = ras_atei
-        ras.bandNumber = 1
-        entries.append(ras)
-        
-        calc = QgsRasterCalculator('1 - (ras@1 / {})'.format(str(ETx)),
-                                    output_dir,
-                                    'GTiff',
-                                    ras_atei.extent(),
-                                    ras_atei.width(),
-                                    ras_atei.height(),
-                                    entries)
-        print(calc.processCalculation())
+        self._run_formula('relative_water_deficit', [aeti_dir], output_name, {'ETx': ETx}, stats=False)
 
 
 
+    @_closes_rasters
     def total_biomass_production(self, raster, output_name, outLabel):
         """
         TBP is computed from the formula:
-            --- TBP = (NPP * 22.22)/1000
+            --- TBP = (NPP * 22.222)/1000
             where:
                 -- NPP - Net Primary Production
                 -- 22.222 is to convert the NPP in gC/m^2 to biomass production in kg/ha
@@ -438,38 +640,18 @@ class IndicatorCalculator:
         --- mean & standard deviation - real number
         --- Total Biomass Production - raster
         """
-        ras_npp_dir = os.path.join(self.rasters_dir, raster)
-        output_dir = os.path.join(self.rasters_dir, output_name)
+        self._run_formula('total_biomass_production', [raster], output_name,
+                          {'factor': 22.222 / 1000}, stats=False)
 
-        ds = gdal.Open(ras_npp_dir)
-        ras_npp = QgsRasterLayer(ras_npp_dir)
+        # TBP is a linear transform of NPP, so are its mean and std
+        NPPm, NPPsd = self._band_stats(self._open(self._raster_path(raster)))
+        TBPm = (NPPm * 22.222) / 1000
+        TBPsd = (NPPsd * 22.222) / 1000
 
-        npp_band1 = self._get_array(ds)
-
-        TBP = (npp_band1 * 22.222) / 1000
-
-        TBPm   = np.nanmean(TBP)
-        TBPsd  = np.nanstd(TBP)
-
-        entries = []
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@1'
-        ras.raster = ras_npp
-        ras.bandNumber = 1
-        entries.append(ras)
-
-        calc = QgsRasterCalculator('(ras@1 * 22.22) / 1000',
-                                    output_dir,
-                                    'GTiff',
-                                    ras_npp.extent(),
-                                    ras_npp.width(),
-                                    ras_npp.height(),
-                                    entries)
-        print(calc.processCalculation())
-
-        print('The mean and standard deviation for', raster, '=', round(TBPm, 2), ',', round(TBPsd, 2))
+        log.debug('The mean and standard deviation for %s = %.2f, %.2f', raster, TBPm, TBPsd)
         outLabel.setText('mean = {}, \nstandard deviation = {}'.format(round(TBPm, 2), round(TBPsd, 2)))
 
+    @_closes_rasters
     def biomass_water_productivity(self, aeti_dir, tbp_dir, output_name, outLabel):
         """
         WPb is computed from the formula:
@@ -482,54 +664,16 @@ class IndicatorCalculator:
         --- mean & standard deviation - real number
         --- Biomass Water Productivity - raster
         """
-        ras_atei_dir = os.path.join(self.rasters_dir, aeti_dir)
-        ras_tbp_dir = os.path.join(self.rasters_dir, tbp_dir)
-        output_dir = os.path.join(self.rasters_dir, output_name)
-
-        ras_atei = QgsRasterLayer(ras_atei_dir)
-        ras_tbp = QgsRasterLayer(ras_tbp_dir)
-
-        ds_aeti = gdal.Open(ras_atei_dir)
-        ds_tbp = gdal.Open(ras_tbp_dir)
-
-        aeti_band = self._get_array(ds_aeti)
-        tbp_band = self._get_array(ds_tbp)
-
         try:
-            WP  = tbp_band/aeti_band*100
+            NPPm, NPPsd = self._run_formula('biomass_water_productivity', [aeti_dir, tbp_dir], output_name)
         except ValueError:
             outLabel.setText('Error: The two Rasters have different sizes!')
             return 0
-        
-        NPPm   = np.nanmean(WP)
-        NPPsd  = np.nanstd(WP)
-
-        entries = []
-
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@1'
-        ras.raster = ras_atei
-        ras.bandNumber = 1
-        entries.append(ras)
-
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@2'
-        ras.raster = ras_tbp
-        ras.bandNumber = 1
-        entries.append(ras)
-
-        calc = QgsRasterCalculator('ras@2 / ras@1 * 100',
-                                    output_dir,
-                                    'GTiff',
-                                    ras_atei.extent(),
-                                    ras_atei.width(),
-                                    ras_atei.height(),
-                                    entries)
-        print(calc.processCalculation())
-
-        print('The mean and standard deviation for WP', '=', round(NPPm, 2), ',', round(NPPsd, 2))
+
+        log.debug('The mean and standard deviation for WP = %.2f, %.2f', NPPm, NPPsd)
         outLabel.setText('mean = {}, \nstandard deviation = {}'.format(round(NPPm, 2), round(NPPsd, 2)))
 
+    @_closes_rasters
     def yield_indicator(self, raster, MC, fc, AOT, HI, output_name, outLabel):
         """
         Yield is computed with the formula: 
@@ -544,38 +688,17 @@ class IndicatorCalculator:
         --- mean & standard deviation - real number
         --- Yield - raster
         """
-        ras_TBP_dir = os.path.join(self.rasters_dir, raster)
-        output_dir = os.path.join(self.rasters_dir, output_name)
-
-        ds = gdal.Open(ras_TBP_dir)
-        ras_npp = QgsRasterLayer(ras_TBP_dir)
-
-        tbp_band1 = self._get_array(ds)
-
-        YIELD = HI * AOT * fc * (tbp_band1 / (1 - MC))
-
-        Yieldm   = np.nanmean(YIELD)
-        Yieldsd  = np.nanstd(YIELD)
-
-        entries = []
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@1'
-        ras.raster = ras_npp
-        ras.bandNumber = 1
-        entries.append(ras)
+        if MC == 1:
+            outLabel.setText('Error: The moisture content (MC) can not be 1!')
+            return 0
 
-        calc = QgsRasterCalculator('{} * {} * {} * (ras@1 / (1 - {}))'.format(HI, AOT, fc, MC),
-                                    output_dir,
-                                    'GTiff',
-                                    ras_npp.extent(),
-                                    ras_npp.width(),
-                                    ras_npp.height(),
-                                    entries)
-        print(calc.processCalculation())
+        Yieldm, Yieldsd = self._run_formula('yield_indicator', [raster], output_name,
+                                            {'factor': HI * AOT * fc / (1 - MC)})
 
-        print('The mean and standard deviation for', raster, '=', round(Yieldm, 2), ',', round(Yieldsd, 2))
+        log.debug('The mean and standard deviation for %s = %.2f, %.2f', raster, Yieldm, Yieldsd)
         outLabel.setText('mean = {}, \nstandard deviation = {}'.format(round(Yieldm, 2), round(Yieldsd, 2)))
 
+    @_closes_rasters
     def crop_water_productivity(self, y_dir, aeti_dir, output_name, outLabel):
         """
         cWP is computed from the formula:
@@ -588,54 +711,16 @@ class IndicatorCalculator:
         --- mean & standard deviation - real number
         --- Crop Water Productivity - raster
         """
-        ras_y_dir = os.path.join(self.rasters_dir, y_dir)
-        ras_atei_dir = os.path.join(self.rasters_dir, aeti_dir)
-        output_dir = os.path.join(self.rasters_dir, output_name)
-
-        ras_y = QgsRasterLayer(ras_y_dir)
-        ras_atei = QgsRasterLayer(ras_atei_dir)
-
-        ds_y = gdal.Open(ras_y_dir)
-        ds_aeti = gdal.Open(ras_atei_dir)
-
-        y_band = self._get_array(ds_y)
-        aeti_band = self._get_array(ds_aeti)
-
         try:
-            cWP  = y_band/aeti_band*100
+            cWPm, cWPsd = self._run_formula('crop_water_productivity', [aeti_dir, y_dir], output_name)
         except ValueError:
             outLabel.setText('Error: The two Rasters have different sizes!')
             return 0
-        
-        cWPm   = np.nanmean(cWP)
-        cWPsd  = np.nanstd(cWP)
-
-        entries = []
-
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@1'
-        ras.raster = ras_y
-        ras.bandNumber = 1
-        entries.append(ras)
-
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@2'
-        ras.raster = ras_atei
-        ras.bandNumber = 1
-        entries.append(ras)
-
-        calc = QgsRasterCalculator('ras@1 / ras@2 * 100',
-                                    output_dir,
-                                    'GTiff',
-                                    ras_atei.extent(),
-                                    ras_atei.width(),
-                                    ras_atei.height(),
-                                    entries)
-        print(calc.processCalculation())
-
-        print('The mean and standard deviation for cWP', '=', round(cWPm, 2), ',', round(cWPsd, 2))
+
+        log.debug('The mean and standard deviation for cWP = %.2f, %.2f', cWPm, cWPsd)
         outLabel.setText('mean = {}, \nstandard deviation = {}'.format(round(cWPm, 2), round(cWPsd, 2)))
 
+    @_closes_rasters
     def overall_consumed_ratio(self, aeti_dir, pcp_dir, output_name, V_ws):
         """
         Overall consumed ratio is computed from the formula:
@@ -655,36 +740,9 @@ class IndicatorCalculator:
             --- OCR - Raster
 
         """
-        ras_atei_dir = os.path.join(self.rasters_dir, aeti_dir)
-        ras_pcp_dir = os.path.join(self.rasters_dir, pcp_dir)
-        output_dir = os.path.join(self.rasters_dir, output_name)
-
-        ras_atei = QgsRasterLayer(ras_atei_dir)
-        ras_pcp = QgsRasterLayer(ras_pcp_dir)
-
-        entries = []
-
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@1'
-        ras.raster = ras_atei
-        ras.bandNumber = 1
-        entries.append(ras)
-
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@2'
-        ras.raster = ras_pcp
-        ras.bandNumber = 1
-        entries.append(ras)
-
-        calc = QgsRasterCalculator('1.0 - (ras@1 - ras@2) / {}'.format(str(V_ws)),
-                                    output_dir,
-                                    'GTiff',
-                                    ras_atei.extent(),
-                                    ras_atei.width(),
-                                    ras_atei.height(),
-                                    entries)
-        print(calc.processCalculation())
+        self._run_formula('overall_consumed_ratio', [aeti_dir, pcp_dir], output_name, {'V_ws': float(V_ws)})
 
+    @_closes_rasters
     def field_application_ratio(self, aeti_dir, pcp_dir, output_name, V_wd):
         """
         Field appliation ratio is computed from the formula:
@@ -705,37 +763,10 @@ class IndicatorCalculator:
         Output:
         --- FAR - Raster
         """
-        ras_atei_dir = os.path.join(self.rasters_dir, aeti_dir)
-        ras_pcp_dir = os.path.join(self.rasters_dir, pcp_dir)
-        output_dir = os.path.join(self.rasters_dir, output_name)
-
-        ras_atei = QgsRasterLayer(ras_atei_dir)
-        ras_pcp = QgsRasterLayer(ras_pcp_dir)
-
-        entries = []
-
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@1'
-        ras.raster = ras_atei
-        ras.bandNumber = 1
-        entries.append(ras)
-
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@2'
-        ras.raster = ras_pcp
-        ras.bandNumber = 1
-        entries.append(ras)
-
-        calc = QgsRasterCalculator('1.0 - (ras@1 - ras@2) / {}'.format(str(V_wd)),
-                                    output_dir,
-                                    'GTiff',
-                                    ras_atei.extent(),
-                                    ras_atei.width(),
-                                    ras_atei.height(),
-                                    entries)
-        print(calc.processCalculation())
+        self._run_formula('field_application_ratio', [aeti_dir, pcp_dir], output_name, {'V_wd': float(V_wd)})
 
 
+    @_closes_rasters
     def depleted_fraction(self, aeti_dir, pcp_dir, output_name, V_c):
         """
         Depleted fraction is computed from the formula:
@@ -756,42 +787,782 @@ class IndicatorCalculator:
         Output:
         --- DF - Raster
         """
-        ras_atei_dir = os.path.join(self.rasters_dir, aeti_dir)
-        ras_pcp_dir = os.path.join(self.rasters_dir, pcp_dir)
-        output_dir = os.path.join(self.rasters_dir, output_name)
-
-        ras_atei = QgsRasterLayer(ras_atei_dir)
-        ras_pcp = QgsRasterLayer(ras_pcp_dir)
-
-        entries = []
-
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@1'
-        ras.raster = ras_atei
-        ras.bandNumber = 1
-        entries.append(ras)
-
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'ras@2'
-        ras.raster = ras_pcp
-        ras.bandNumber = 1
-        entries.append(ras)
-
-        calc = QgsRasterCalculator('1.0 - ras@1/ (ras@2 + {})'.format(str(V_c)),
-                                    output_dir,
-                                    'GTiff',
-                                    ras_atei.extent(),
-                                    ras_atei.width(),
-                                    ras_atei.height(),
-                                    entries)
-        print(calc.processCalculation())
-
-    def _get_array(self, ds, nan_value=-9999):
-        ras = ds.GetRasterBand(1).ReadAsArray()
-        ras = ras.astype(np.float64)
-        # Removing values that contain no data value 
-        ras[ras < 0.0] = float('nan')
-        return ras
+        self._run_formula('depleted_fraction', [aeti_dir, pcp_dir], output_name, {'V_c': float(V_c)})
+
+    @_closes_rasters
+    def run_batch(self, specs):
+        """
+        Computes several indicators at once. specs is a list of pairs
+        (method_name, kwargs), e.g. ('beneficial_fraction', {...}). The
+        indicators run on a thread pool, as dask delayed tasks when dask is
+        installed, GDAL releases the GIL while reading and writing so their
+        I/O overlaps. Without dask half of the CPUs are used, the other half
+        is left to GDAL's own decompression threads (GDAL_NUM_THREADS).
+
+        A spec that reads the output of an earlier one (e.g. a mem:// raster,
+        see _raster_path), or writes a raster an earlier one reads, starts
+        once that one finished, see _batch_stages.
+
+        Qt widgets can only be used from the GUI thread, the outLabel of each
+        spec is replaced by a buffer and updated once all the tasks finish.
+
+        Output:
+        --- list with the value returned by each indicator method
+        """
+        calls = []
+        labels = []
+        for method_name, kwargs in specs:
+            kwargs = dict(kwargs)
+            label = kwargs.get('outLabel')
+            if label is not None:
+                kwargs['outLabel'] = _LabelBuffer()
+            labels.append((label, kwargs.get('outLabel')))
+            calls.append((getattr(self, method_name), kwargs))
+
+        results = [None] * len(calls)
+        stages = self._batch_stages(specs)
+        if use_dask:
+            for stage in stages:
+                tasks = [dask.delayed(calls[i][0])(**calls[i][1]) for i in stage]
+                values = dask.compute(*tasks, scheduler='threads', num_workers=os.cpu_count())
+                for i, value in zip(stage, values):
+                    results[i] = value
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, os.cpu_count() // 2)) as executor:
+                for stage in stages:
+                    futures = [(i, executor.submit(calls[i][0], **calls[i][1])) for i in stage]
+                    for i, future in futures:
+                        results[i] = future.result()
+
+        for label, buffer in labels:
+            if label is not None and buffer.text is not None:
+                label.setText(buffer.text)
+        return results
+
+    def _batch_stages(self, specs):
+        """
+        Groups the specs of run_batch in stages that run one after the other,
+        the specs of a stage run concurrently. A spec goes after every earlier
+        spec that writes one of the rasters it reads (any string argument, or
+        string in a list argument, other than output_name), reads the raster
+        it writes, or writes the same raster.
+
+        Output:
+        --- list of stages - lists of indices of specs
+        """
+        outputs = []
+        inputs = []
+        for _, kwargs in specs:
+            outputs.append(kwargs.get('output_name'))
+            names = set()
+            for key, value in kwargs.items():
+                if key == 'output_name':
+                    continue
+                if isinstance(value, str):
+                    names.add(value)
+                elif isinstance(value, (list, tuple)):
+                    names.update(item for item in value if isinstance(item, str))
+            inputs.append(names)
+
+        levels = []
+        for i in range(len(specs)):
+            level = 0
+            for j in range(i):
+                if (outputs[j] is not None and outputs[j] in inputs[i]) or \
+                        (outputs[i] is not None and (outputs[i] in inputs[j] or outputs[i] == outputs[j])):
+                    level = max(level, levels[j] + 1)
+            levels.append(level)
+
+        stages = [[] for _ in range(max(levels, default=-1) + 1)]
+        for i, level in enumerate(levels):
+            stages[level].append(i)
+        return stages
+
+    @_closes_rasters
+    def aeti_summary(self, path):
+        """
+        Computes the mean, the standard deviation and the 95th and 99th
+        percentiles of the raster in path with a single block by block sweep.
+        The result is kept while the file is not modified, so equity, adequacy
+        and relative_water_deficit on the same AETI raster read it only once.
+
+        The percentiles are computed from an overview on large rasters (see
+        _overview_percentiles), otherwise from the valid values collected
+        during the sweep: all of them up to 4 * APPROX_MIN_PIXELS pixels, a
+        regular sample of that size beyond.
+
+        Output:
+        --- mean, std, p95, p99 - real numbers
+        """
+        key = (path, self._version(path))
+        with self._cache_guard:
+            summary = self._summaries.get(key)
+        if summary is None:
+            summary = self._summarize(path)
+            with self._cache_guard:
+                # Keep the last few rasters, e.g. the AETI of several seasons
+                if len(self._summaries) >= 8:
+                    self._summaries.pop(next(iter(self._summaries)))
+                self._summaries[key] = summary
+        return summary
+
+    def _summarize(self, path):
+        """
+        Sweeps the raster in path, see aeti_summary.
+        """
+        ds = self._open(path)
+        pcts = self._overview_percentiles(ds, (95, 99))
+        # Take one every step valid values, offset carries the stride across blocks.
+        # The values are copied straight into sample, sized for the worst case
+        # (no no data), instead of concatenating per block copies at the end
+        size = ds.RasterXSize * ds.RasterYSize
+        step = -(-size // (4 * self.APPROX_MIN_PIXELS))
+        offset = 0
+        if pcts is None:
+            sample = np.empty(-(-size // step), dtype=np.float32)
+            filled = 0
+
+        acc = (0, 0.0, 0.0)
+        for _, arr, mask in self._iter_blocks(ds):
+            acc = merge_stats(*acc, *stats_kernel(arr, mask))
+
+            if pcts is None:
+                valid = ~mask
+                if step == 1:
+                    # The blocks are C-contiguous, ravel returns views
+                    count = np.count_nonzero(valid)
+                    np.compress(valid.ravel(), arr.ravel(), out=sample[filled:filled + count])
+                else:
+                    vals = arr[valid]
+                    count = len(range(offset, vals.size, step))
+                    sample[filled:filled + count] = vals[offset::step]
+                    offset = (offset - vals.size) % step
+                filled += count
+
+        mean, std = self._finish_stats(*acc)
+        if pcts is None:
+            pcts = self._nanpercentiles(sample[:filled], (95, 99), overwrite=True)
+        return mean, std, pcts[0], pcts[1]
+
+    def _run_formula(self, name, rasters, output_name, factors=None, stats=True):
+        """
+        Computes the formula of the indicator name (see _FORMULAS) block by
+        block from the rasters (file names in the rasters directory) and the
+        scalar factors, and writes it to output_name. The formula is compiled
+        once with numexpr, which evaluates it multithreaded without temporary
+        arrays, or the equivalent kernel is used when numexpr is missing.
+        The fractions are written scaled to Int16 when FRACTION_SCALE is set.
+
+        Raises ValueError when the rasters have different sizes.
+
+        Output:
+        --- mean & standard deviation of the output - real number (or None)
+        """
+        formula = _FORMULAS[name]
+        factors = factors or {}
+        datasets = [self._open(self._raster_path(raster)) for raster in rasters]
+        output_dir = self._raster_path(output_name)
+
+        if use_numexpr:
+            expr = _compile_formula(formula.expression, formula.inputs)
+            scalars = {key: np.float32(value) for key, value in factors.items()}
+            scalars['NaN'] = np.float32('nan')
+            raster_names = [key for key in formula.inputs if key not in scalars]
+
+            def func(*arrs):
+                values = dict(zip(raster_names, arrs), **scalars)
+                return expr(*[values[key] for key in formula.inputs])
+        else:
+            # Python floats, as in the warm-up of _formula_kernel (e.g. ETp is a
+            # np.float32 percentile), so Numba reuses that specialization
+            factors = {key: float(value) for key, value in factors.items()}
+            kernel = _formula_kernel(name, tuple(self._block_dtype(ds) for ds in datasets),
+                                     tuple(sorted(factors)))
+
+            def func(*arrs):
+                return kernel(*arrs, **factors)
+
+        scale = self.FRACTION_SCALE if name in _FRACTION_FORMULAS else None
+        return self._map_blocks(output_dir, datasets, func, stats, scale)
+
+    def _get_array(self, ds, nan_value=-9999, dtype=np.float32):
+        """
+        Reads the whole first band of ds, see _read_block.
+        """
+        return self._read_block(ds, (0, 0, ds.RasterXSize, ds.RasterYSize), dtype)
+
+    def release_raster(self, name):
+        """
+        Deletes a mem:// raster (see _raster_path) and frees its memory.
+        """
+        if name.startswith(self.MEMORY_PREFIX):
+            self._forget_handles(self._raster_path(name))
+            gdal.Unlink(self._raster_path(name))
+
+    def _raster_path(self, name):
+        """
+        Returns the path of the raster name of the rasters directory. Names
+        starting with mem:// are transient rasters kept in GDAL's in-memory
+        file system (/vsimem/), e.g. an output only used as input of a later
+        indicator in run_batch (which runs it once the output is written),
+        skipping writing and decoding it on disk.
+        They use RAM on top of the GDAL_CACHEMAX block cache until
+        release_raster is called.
+
+        The paths are cached per rasters directory (see _resolve_raster_path),
+        a batch resolves the same few names for every indicator.
+        """
+        return _resolve_raster_path(self.rasters_dir, name, self.MEMORY_PREFIX)
+
+    def _version(self, path):
+        """
+        Returns the modification time and size of path, part of the keys of the
+        caches of the rasters so they are read again once the file changes.
+        """
+        if path.startswith('/vsimem/'):
+            stat = gdal.VSIStatL(path)
+            return (stat.mtime, stat.size) if stat is not None else None
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _same_size(self, *datasets):
+        """
+        Checks that all the datasets have the same number of rows and columns,
+        NumPy would otherwise broadcast some mismatched shapes silently.
+        """
+        sizes = {(ds.RasterXSize, ds.RasterYSize) for ds in datasets}
+        return len(sizes) == 1
+
+    def _open(self, path):
+        """
+        Opens a raster read-only, the same dataset serves to read the values
+        and as template (size, geotransform, projection) of the output. The
+        handle is reused by later calls on the same file while it is not
+        modified, until the outermost indicator call returns (see
+        _closes_rasters). GDAL datasets can not be read from several threads
+        at once, so each thread (see run_batch) gets its own handle.
+        """
+        key = (path, threading.get_ident())
+        version = self._version(path)
+        with self._cache_guard:
+            handle = self._handles.get(key)
+        if handle is None or handle[0] != version:
+            with self._gdal_options():
+                handle = (version, gdal.Open(path, gdal.GA_ReadOnly))
+            with self._cache_guard:
+                self._handles[key] = handle
+        return handle[1]
+
+    @contextmanager
+    def _gdal_options(self):
+        """
+        Sets GDAL_CONFIG for the current thread only (QGIS and the other
+        plugins keep their configuration), restoring the previous values on
+        exit. The options not set by the user are applied.
+        """
+        previous = {key: gdal.GetThreadLocalConfigOption(key, None) for key in self.GDAL_CONFIG}
+        for key, value in self.GDAL_CONFIG.items():
+            if gdal.GetConfigOption(key) is None:
+                gdal.SetThreadLocalConfigOption(key, value)
+        try:
+            yield
+        finally:
+            for key, value in previous.items():
+                gdal.SetThreadLocalConfigOption(key, value)
+
+    def _forget_handles(self, path):
+        """
+        Drops the open handles of path in every thread, which closes them once
+        no caller uses them anymore.
+        """
+        with self._cache_guard:
+            for key in [key for key in self._handles if key[0] == path]:
+                del self._handles[key]
+
+    def _load_array(self, path):
+        """
+        Returns the dataset, the array and the no data mask of the raster in
+        path. The arrays are not kept, only equity_map needs a whole raster in
+        memory.
+        """
+        ds = self._open(path)
+        ras, mask = self._get_array(ds)
+        return ds, ras, mask
+
+    def _read_block(self, ds, win, dtype=np.float32):
+        """
+        Reads the window (xoff, yoff, xsize, ysize) of the first band of ds.
+        GDAL converts the values to dtype (float32 by default, the precision
+        of the indicators does not need more) while reading. With dtype None
+        8 and 16 bit integer bands (e.g. WaPOR's Int16) are read as they are,
+        moving half the bytes of float32 through the kernels, which convert
+        each value while computing.
+
+        The values are left untouched, the no data pixels (see _nodata_mask)
+        are returned as a boolean mask, so the statistics and kernels work on
+        plain values instead of checking for NaN everywhere.
+
+        Output:
+        --- array, no data mask
+        """
+        band = ds.GetRasterBand(1)
+        if dtype is None and band.DataType in _NATIVE_DTYPES:
+            ras = band.ReadAsArray(*win)
+        else:
+            buf_type = gdal.GDT_Float64 if dtype == np.float64 else gdal.GDT_Float32
+            ras = band.ReadAsArray(*win, buf_type=buf_type)
+        return ras, self._nodata_mask(band, ras)
+
+    def _block_dtype(self, ds):
+        """
+        Returns the dtype of the blocks _read_block(ds, win, None) reads.
+        """
+        return _NATIVE_DTYPES.get(ds.GetRasterBand(1).DataType, np.dtype(np.float32))
+
+    def _nodata_mask(self, band, ras):
+        """
+        Returns the no data pixels of ras, read from band: the ones equal to
+        the no data value of the band, and NaN in float bands. Rasters that do
+        not declare a no data value use negative fill values, all negative
+        pixels (and NaN, read from float bands) are masked then.
+        """
+        nodata = band.GetNoDataValue()
+        if nodata is None:
+            mask = ras < 0.0
+            if ras.dtype.kind == 'f':
+                mask |= np.isnan(ras)
+            return mask
+        if np.isnan(nodata):
+            return np.isnan(ras)
+        mask = ras == nodata
+        if band.DataType in (gdal.GDT_Float32, gdal.GDT_Float64):
+            mask |= np.isnan(ras)
+        return mask
+
+    def _iter_blocks(self, ds, dtype=np.float32):
+        """
+        Yields the windows (xoff, yoff, xsize, ysize), arrays (see
+        _read_block) and no data masks of the first band of ds, see
+        _iter_windows.
+        """
+        for win in self._iter_windows(ds):
+            yield (win,) + self._read_block(ds, win, dtype)
+
+    def _iter_windows(self, ds, *others):
+        """
+        Yields the windows (xoff, yoff, xsize, ysize) covering ds, aligned to
+        the native block size of its first band and of the bands of others
+        (rasters of the same size read window by window together with ds), see
+        _block_shape.
+        """
+        block_x, block_y = self._block_shape(ds, *others)
+
+        for yoff in range(0, ds.RasterYSize, block_y):
+            ysize = min(block_y, ds.RasterYSize - yoff)
+            for xoff in range(0, ds.RasterXSize, block_x):
+                xsize = min(block_x, ds.RasterXSize - xoff)
+                yield (xoff, yoff, xsize, ysize)
+
+    def _block_shape(self, *datasets):
+        """
+        Returns the size (x, y) of the windows of _iter_windows: the least
+        common multiple of the block sizes of the datasets (at most the
+        raster size), so every window covers whole blocks of each of them and
+        no block is decoded twice when they are tiled differently (e.g. a
+        tiled AETI and a striped precipitation). When that window exceeds
+        4 * MIN_BLOCK_PIXELS (unrelated tile sizes, e.g. 256 and 500, or tiles
+        mixed with tall strips) the block size of the first dataset is used
+        instead and the other ones are read across their block boundaries.
+        Strip layouts report blocks only a few rows high, so several of them
+        are grouped.
+        """
+        first_x, first_y = datasets[0].GetRasterBand(1).GetBlockSize()
+        block_x = block_y = 1
+        for ds in datasets:
+            x, y = ds.GetRasterBand(1).GetBlockSize()
+            block_x = min(block_x * x // math.gcd(block_x, x), ds.RasterXSize)
+            block_y = min(block_y * y // math.gcd(block_y, y), ds.RasterYSize)
+        if block_x * block_y > 4 * self.MIN_BLOCK_PIXELS:
+            block_x, block_y = first_x, first_y
+        return block_x, block_y * max(1, self.MIN_BLOCK_PIXELS // (block_x * block_y))
+
+    def _block_stats(self, ds):
+        """
+        Computes the mean and the standard deviation of the valid values of
+        ds in a single pass, merging the statistics of the blocks.
+        """
+        acc = (0, 0.0, 0.0)
+        for _, arr, mask in self._iter_blocks(ds):
+            acc = merge_stats(*acc, *stats_kernel(arr, mask))
+        return self._finish_stats(*acc)
+
+    def _band_stats(self, ds, approximate=False):
+        """
+        Returns the mean and the standard deviation of the first band of ds.
+        When the band declares a no data value they are computed in C by GDAL
+        (and cached in the .aux.xml file), otherwise the negative values still
+        have to be masked (see _nodata_mask) and the statistics are
+        accumulated by blocks.
+        """
+        band = ds.GetRasterBand(1)
+        if band.GetNoDataValue() is None:
+            return self._block_stats(ds)
+        _, _, mean, std = band.ComputeStatistics(approximate)
+        return mean, std
+
+    def _finish_stats(self, n, mean, m2):
+        """
+        Returns the mean and the standard deviation from the count, the mean
+        and the sum of squared deviations from the mean of a set of values
+        (see stats_kernel and merge_stats).
+        """
+        if n == 0:
+            return float('nan'), float('nan')
+        return float(mean), float(np.sqrt(m2 / n))
+
+    def _map_blocks(self, output_dir, inputs, func, stats=True, scale=None):
+        """
+        Applies func block by block to the rasters in inputs and writes the
+        result to a tiled Float32 GeoTIFF with the georeference of the first
+        input. func gets the raw values, the pixels that are no data in any
+        input are set to NaN afterwards. If stats is True the mean and
+        standard deviation of the output are accumulated while writing it.
+
+        With scale the output is written as Int16 (round(value * scale), see
+        _quantize) with the inverse scale factor in its metadata, GDAL and
+        QGIS unscale the values when reading them. The statistics are computed
+        before the rounding.
+
+        Output:
+        --- mean & standard deviation of the output - real number (or None)
+        """
+        template_ds = inputs[0]
+        if not self._same_size(*inputs):
+            raise ValueError('The rasters have different sizes')
+
+        with self._output_lock(output_dir):
+            if scale:
+                out_ds = self._create_output(output_dir, template_ds, gdal.GDT_Int16,
+                                             self.INT16_NODATA, scale)
+            else:
+                out_ds = self._create_output(output_dir, template_ds)
+            out_band = out_ds.GetRasterBand(1)
+
+            acc = (0, 0.0, 0.0)
+            # The co-located blocks of the inputs are read one after the other,
+            # func consumes them while they are in cache. It gets the integer
+            # bands as they are, see _read_block
+            for win in self._iter_windows(*inputs):
+                arr, mask = self._read_block(template_ds, win, None)
+                arrs = [arr]
+                for ds in inputs[1:]:
+                    ras, ras_mask = self._read_block(ds, win, None)
+                    arrs.append(ras)
+                    mask |= ras_mask
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    out = func(*arrs)
+                out[mask] = np.nan
+                out_band.WriteArray(self._quantize(out, scale) if scale else out, win[0], win[1])
+
+                if not stats:
+                    continue
+                acc = merge_stats(*acc, *stats_kernel(out, mask))
+
+            self._finish_output(out_ds)
+            out_ds = None
+        if stats:
+            return self._finish_stats(*acc)
+
+    def _quantize(self, out, scale):
+        """
+        Returns out * scale rounded to Int16, NaN becomes INT16_NODATA and
+        the values beyond the Int16 range are clipped.
+        """
+        valid = ~np.isnan(out)
+        quantized = np.full(out.shape, self.INT16_NODATA, dtype=np.int16)
+        quantized[valid] = np.clip(np.rint(out[valid] * scale), -32767, 32767)
+        return quantized
+
+    def _nanpercentiles(self, vals, percentiles, overwrite=False):
+        """
+        Computes the percentiles of an array without NaNs with a single
+        np.partition call (quickselect, O(N)) for all of them, interpolating
+        linearly between the closest ranks as np.nanpercentile does. With
+        overwrite=True vals is partitioned in place instead of copied, for
+        callers that built it only for this.
+
+        Output:
+        --- list with one real number per requested percentile
+        """
+        n = vals.size
+        if n == 0 or not percentiles:
+            return [float('nan')] * len(percentiles)
+
+        positions = [q / 100.0 * (n - 1) for q in percentiles]
+        kth = sorted({int(np.floor(pos)) for pos in positions} |
+                     {int(np.ceil(pos)) for pos in positions})
+        if overwrite:
+            vals.partition(kth)
+            part = vals
+        else:
+            part = np.partition(vals, kth)
+
+        pcts = []
+        for pos in positions:
+            lo = int(np.floor(pos))
+            hi = int(np.ceil(pos))
+            # Interpolated as Python floats, float32 would leak into the
+            # labels and the factors of the formulas
+            lo_val, hi_val = float(part[lo]), float(part[hi])
+            pcts.append(lo_val + (hi_val - lo_val) * (pos - lo))
+        return pcts
+
+    def _block_percentiles(self, ds, percentiles):
+        """
+        Computes the exact percentiles of the valid values of the first band of
+        ds (linear interpolation, as np.nanpercentile) reading it by blocks,
+        without holding the raster in memory. Every pass over the blocks
+        builds, for each rank still unknown, a PERCENTILE_BINS histogram of the
+        bin it fell in during the previous pass (the band's range at first).
+        Once that bin holds at most MIN_BLOCK_PIXELS values they are collected
+        and partitioned, usually on the second or third pass. A bin narrower
+        than the float32 resolution holds a single value, its smallest value
+        is taken however many pixels have it.
+
+        Output:
+        --- list with one real number per requested percentile
+        """
+        bins = self.PERCENTILE_BINS
+        try:
+            vmin, vmax = ds.GetRasterBand(1).ComputeRasterMinMax(False)
+        except RuntimeError:
+            # Every pixel is no data
+            return [float('nan')] * len(percentiles)
+        # Without a no data value the negative pixels are masked, the range
+        # only has to hold the valid values
+        if ds.GetRasterBand(1).GetNoDataValue() is None:
+            vmin = max(vmin, 0.0)
+        vmax = max(vmax, vmin)
+
+        def bin_index(vals, levels):
+            """
+            Returns the values that fall in the nested bins (lo, width, b) of
+            levels, the last level has no bin yet, and their bin in it. The
+            blocks are binned in float32, only the few values left in a bin
+            are converted to float64 for the narrower levels.
+            """
+            for lo, width, b in levels:
+                idx = np.clip(((vals - lo) / width if width > 0 else vals * 0).astype(np.int64), 0, bins - 1)
+                if b is None:
+                    return vals, idx
+                vals = vals[idx == b].astype(np.float64)
+            return vals, None
+
+        # Each rank is resolved independently, state: levels, values below them
+        top = [(vmin, (vmax - vmin) / bins, None)]
+        pending = None
+        values = {}
+        n = None
+        while pending is None or pending:
+            hists = {}
+            collect = {}
+            for rank, (levels, below) in (pending or {None: (top, 0)}).items():
+                if levels[-1][2] is None:
+                    hists[rank] = (levels, np.zeros(bins, dtype=np.int64))
+                else:
+                    collect[rank] = (levels, [])
+
+            for _, arr, mask in self._iter_blocks(ds):
+                vals = arr[~mask]
+                for levels, hist in hists.values():
+                    _, idx = bin_index(vals, levels)
+                    hist += np.bincount(idx, minlength=bins)
+                for levels, found in collect.values():
+                    in_bin, _ = bin_index(vals, levels)
+                    found.append(in_bin)
+
+            if pending is None:
+                # First pass, the histogram of the whole range gives the ranks
+                _, hist = hists[None]
+                n = int(hist.sum())
+                if n == 0:
+                    return [float('nan')] * len(percentiles)
+                positions = [q / 100.0 * (n - 1) for q in percentiles]
+                ranks = {int(np.floor(pos)) for pos in positions} | {int(np.ceil(pos)) for pos in positions}
+                pending = {rank: (top, 0) for rank in ranks}
+                hists = {rank: hists[None] for rank in ranks}
+
+            for rank, (levels, found) in collect.items():
+                in_bin = np.concatenate(found)
+                below = pending.pop(rank)[1]
+                if in_bin.size > self.MIN_BLOCK_PIXELS:
+                    values[rank] = in_bin.min()
+                else:
+                    values[rank] = np.partition(in_bin, rank - below)[rank - below]
+
+            for rank, (levels, hist) in hists.items():
+                below = pending[rank][1]
+                cum = np.cumsum(hist) + below
+                b = int(np.searchsorted(cum, rank, side='right'))
+                lo, width, _ = levels[-1]
+                levels = levels[:-1] + [(lo, width, b)]
+                below = int(cum[b] - hist[b])
+                if hist[b] > self.MIN_BLOCK_PIXELS and width > np.spacing(np.float32(lo + (b + 1) * width)):
+                    levels = levels + [(lo + b * width, width / bins, None)]
+                pending[rank] = (levels, below)
+
+        pcts = []
+        for pos in positions:
+            lo = float(values[int(np.floor(pos))])
+            hi = float(values[int(np.ceil(pos))])
+            pcts.append(lo + (hi - lo) * (pos - int(np.floor(pos))))
+        return pcts
+
+    def _overview_percentiles(self, ds, percentiles):
+        """
+        Estimates the percentiles of the first band of ds, when it has at least
+        4 * APPROX_MIN_PIXELS pixels, from its coarsest overview that still has
+        APPROX_MIN_PIXELS (a few million samples estimate the 95th and 99th
+        percentiles within a fraction of a percent). Rasters without overviews
+        get them built once with nearest neighbour resampling, which keeps the
+        original values, in an .ovr file that later calls reuse.
+
+        Only overviews known to be resampled with the nearest value are used,
+        averaged ones (e.g. the outputs, see _finish_output) smooth the tails
+        and bias the high percentiles low.
+
+        Output:
+        --- list with one real number per requested percentile, or None for
+            small rasters and when no suitable overview exists or could be built
+        """
+        band = ds.GetRasterBand(1)
+        if band.XSize * band.YSize >= 4 * self.APPROX_MIN_PIXELS:
+            if band.GetOverviewCount() == 0:
+                self._build_overviews(ds)
+                band = ds.GetRasterBand(1)
+            if self._overview_resampling(ds) != 'NEAREST':
+                return None
+
+            overview = None
+            for i in range(band.GetOverviewCount()):
+                ov = band.GetOverview(i)
+                if ov.XSize * ov.YSize >= self.APPROX_MIN_PIXELS and \
+                        (overview is None or ov.XSize * ov.YSize < overview.XSize * overview.YSize):
+                    overview = ov
+
+            if overview is not None:
+                sample = overview.ReadAsArray(buf_type=gdal.GDT_Float32)
+                sample = sample[~self._nodata_mask(band, sample)]
+                return self._nanpercentiles(sample, percentiles, overwrite=True)
+
+        return None
+
+    def _build_overviews(self, ds, resampling='NEAREST', min_pixels=None):
+        """
+        Builds overviews (2x, 4x, ...) of ds until they are smaller than
+        min_pixels (APPROX_MIN_PIXELS by default). A failure (e.g. read-only
+        directory) only means the raster is read at full resolution, e.g. the
+        percentiles are computed from a sample of the full raster.
+        """
+        min_pixels = min_pixels or self.APPROX_MIN_PIXELS
+        levels = []
+        factor = 2
+        while ds.RasterXSize * ds.RasterYSize // (factor * factor) >= min_pixels:
+            levels.append(factor)
+            factor *= 2
+        if not levels:
+            return
+        try:
+            ds.BuildOverviews(resampling, levels)
+        except RuntimeError as e:
+            log.warning('Could not build the overviews of %s: %s', ds.GetDescription(), e)
+            return
+        # GDAL does not record the resampling of most methods, keep it for
+        # _overview_resampling (in the .aux.xml file of read-only rasters)
+        ds.SetMetadataItem(self.OVERVIEW_RESAMPLING_KEY, resampling.upper())
+
+    def _overview_resampling(self, ds):
+        """
+        Returns the resampling of the overviews of ds, as recorded by
+        _build_overviews or by GDAL in the RESAMPLING metadata of the overview
+        bands, None when unknown.
+        """
+        resampling = ds.GetMetadataItem(self.OVERVIEW_RESAMPLING_KEY)
+        if resampling is None:
+            band = ds.GetRasterBand(1)
+            if band.GetOverviewCount() > 0:
+                resampling = band.GetOverview(0).GetMetadataItem('RESAMPLING')
+        return resampling.upper() if resampling else None
+
+    def _write_array(self, out_arr, template_ds, output_dir, data_type=gdal.GDT_Float32, nodata=float('nan')):
+        """
+        Writes an array as a single band GeoTIFF (Float32 with NaN as no data by
+        default) with the size, geotransform and projection of template_ds.
+        """
+        with self._output_lock(output_dir):
+            out_ds = self._create_output(output_dir, template_ds, data_type, nodata)
+            out_band = out_ds.GetRasterBand(1)
+            out_band.WriteArray(out_arr)
+            self._finish_output(out_ds)
+            out_ds = None
+
+    def _output_lock(self, output_dir):
+        """
+        Returns the lock of an output path, GDAL datasets can not be written
+        from several threads, so run_batch tasks writing to the same file take
+        turns.
+        """
+        with self._locks_guard:
+            return self._output_locks.setdefault(output_dir, threading.Lock())
+
+    def _finish_output(self, out_ds):
+        """
+        Builds the internal overviews of an output once its values are written
+        and flushes it, so the rasters open fast in QGIS and as inputs of other
+        indicators. Classes (Byte) are resampled with the nearest value, the
+        rest with the average.
+        """
+        out_band = out_ds.GetRasterBand(1)
+        resampling = 'NEAREST' if out_band.DataType == gdal.GDT_Byte else 'AVERAGE'
+        self._build_overviews(out_ds, resampling, self.OUTPUT_BLOCK_SIZE ** 2)
+        out_band.FlushCache()
+
+    def _create_output(self, output_dir, template_ds, data_type=gdal.GDT_Float32, nodata=float('nan'), scale=None):
+        """
+        Creates a single band GeoTIFF (Float32 with NaN as no data by default)
+        with the size, geotransform and projection of template_ds, and the
+        scale factor 1 / scale for values stored scaled. The file is
+        tiled (overviews are added by _finish_output) and compressed with ZSTD
+        (DEFLATE if this GDAL build lacks it) using all the CPUs, and switches
+        to BigTIFF when it may exceed 4 GB.
+        """
+        # output_dir may be open for reading (Windows does not allow
+        # overwriting an open file)
+        self._forget_handles(output_dir)
+        driver = gdal.GetDriverByName('GTiff')
+        compression = 'ZSTD' if 'ZSTD' in driver.GetMetadataItem('DMD_CREATIONOPTIONLIST') else 'DEFLATE'
+        # Floating point predictor for float rasters, horizontal differencing otherwise
+        predictor = 3 if data_type in (gdal.GDT_Float32, gdal.GDT_Float64) else 2
+        out_ds = driver.Create(output_dir,
+                               template_ds.RasterXSize,
+                               template_ds.RasterYSize,
+                               1,
+                               data_type,
+                               options=['TILED=YES',
+                                        'BLOCKXSIZE={}'.format(self.OUTPUT_BLOCK_SIZE),
+                                        'BLOCKYSIZE={}'.format(self.OUTPUT_BLOCK_SIZE),
+                                        'COMPRESS={}'.format(compression),
+                                        'PREDICTOR={}'.format(predictor),
+                                        'NUM_THREADS=ALL_CPUS',
+                                        'BIGTIFF=IF_SAFER'])
+        out_ds.SetGeoTransform(template_ds.GetGeoTransform())
+        out_ds.SetProjection(template_ds.GetProjection())
+        out_band = out_ds.GetRasterBand(1)
+        out_band.SetNoDataValue(nodata)
+        if scale:
+            out_band.SetScale(1.0 / scale)
+            out_band.SetOffset(0.0)
+        return out_ds
     
     def crop_yield(self):
         raise NotImplementedError("Indicator: 'Crop Yield' not implemented yet.")
@@ -0,0 +1,201 @@
+"""
+    Per-pixel kernels used by the indicator calculator.
+
+    Every kernel fills and returns the preallocated float array `out` (the
+    inputs may be integer rasters, they are converted per value), evaluating the
+    whole expression in a single loop when Numba is available, so compound
+    formulas do not allocate one temporary array per operation. Without Numba
+    the same kernels are evaluated with NumPy ufuncs writing into `out`.
+
+    Numba's fastmath is restricted to flags that keep NaN semantics, the
+    rasters use NaN as no data value.
+
+    Numba is not shipped with QGIS, it has to be installed in the Python QGIS
+    runs (on Windows from the OSGeo4W shell: python -m pip install numba).
+"""
+import threading
+from functools import wraps
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+    use_numba = True
+except ImportError:
+    print("Consider installing `numba` for faster indicator computations.")
+    use_numba = False
+
+
+def merge_stats(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """
+        Merges the count, mean and M2 of two sets of values (Chan et al.),
+        avoiding the cancellation of the sum of squares formula.
+    """
+    n = n_a + n_b
+    if n == 0:
+        return 0, 0.0, 0.0
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    m2 = m2_a + m2_b + delta * delta * (n_a * (n_b / n))
+    return n, mean, m2
+
+
+if use_numba:
+    _JIT_OPTIONS = {'parallel': True,
+                    'fastmath': {'contract', 'arcp'},
+                    'error_model': 'numpy',
+                    'cache': True}
+
+    merge_stats = njit(cache=True)(merge_stats)
+
+    @njit(**_JIT_OPTIONS)
+    def ratio_kernel(num, den, factor, out):
+        """
+            out = num / den * factor, NaN where den is 0.
+        """
+        for i in prange(num.shape[0]):
+            for j in range(num.shape[1]):
+                d = den[i, j]
+                if d == 0.0:
+                    out[i, j] = np.nan
+                else:
+                    out[i, j] = num[i, j] / d * factor
+        return out
+
+    @njit(**_JIT_OPTIONS)
+    def linear_kernel(arr, factor, offset, out):
+        """
+            out = arr * factor + offset
+        """
+        for i in prange(arr.shape[0]):
+            for j in range(arr.shape[1]):
+                out[i, j] = arr[i, j] * factor + offset
+        return out
+
+    @njit(**_JIT_OPTIONS)
+    def balance_kernel(aeti, pcp, volume, out):
+        """
+            out = 1 - (aeti - pcp) / volume
+        """
+        inv_volume = 1.0 / volume
+        for i in prange(aeti.shape[0]):
+            for j in range(aeti.shape[1]):
+                out[i, j] = 1.0 - (aeti[i, j] - pcp[i, j]) * inv_volume
+        return out
+
+    @njit(**_JIT_OPTIONS)
+    def depleted_kernel(aeti, pcp, volume, out):
+        """
+            out = 1 - aeti / (pcp + volume), NaN where pcp + volume is 0.
+        """
+        for i in prange(aeti.shape[0]):
+            for j in range(aeti.shape[1]):
+                d = pcp[i, j] + volume
+                if d == 0.0:
+                    out[i, j] = np.nan
+                else:
+                    out[i, j] = 1.0 - aeti[i, j] / d
+        return out
+
+    @njit(**_JIT_OPTIONS)
+    def stats_kernel(arr, mask):
+        """
+            Count, mean and sum of squared deviations from the mean (M2, in
+            float64) of the values of arr that are neither masked nor NaN, in
+            a single pass: Welford's update along each row, the rows are
+            merged with merge_stats.
+        """
+        rows = arr.shape[0]
+        row_n = np.zeros(rows, dtype=np.int64)
+        row_mean = np.zeros(rows)
+        row_m2 = np.zeros(rows)
+        for i in prange(rows):
+            n = 0
+            mean = 0.0
+            m2 = 0.0
+            for j in range(arr.shape[1]):
+                v = arr[i, j]
+                if not mask[i, j] and v == v:
+                    n += 1
+                    delta = v - mean
+                    mean += delta / n
+                    m2 += delta * (v - mean)
+            row_n[i] = n
+            row_mean[i] = mean
+            row_m2[i] = m2
+
+        n = 0
+        mean = 0.0
+        m2 = 0.0
+        for i in range(rows):
+            n, mean, m2 = merge_stats(n, mean, m2, row_n[i], row_mean[i], row_m2[i])
+        return n, mean, m2
+
+    # Numba's workqueue threading layer (the one available everywhere) aborts
+    # the process when parallel kernels run from several threads at once,
+    # e.g. the tasks of run_batch. The calls take turns, each one already
+    # uses all the CPUs.
+    _PARALLEL_LOCK = threading.Lock()
+
+    def _serialized(kernel):
+        @wraps(kernel)
+        def call(*args, **kwargs):
+            with _PARALLEL_LOCK:
+                return kernel(*args, **kwargs)
+        return call
+
+    ratio_kernel = _serialized(ratio_kernel)
+    linear_kernel = _serialized(linear_kernel)
+    balance_kernel = _serialized(balance_kernel)
+    depleted_kernel = _serialized(depleted_kernel)
+    stats_kernel = _serialized(stats_kernel)
+
+else:
+    def ratio_kernel(num, den, factor, out):
+        """
+            out = num / den * factor, NaN where den is 0.
+        """
+        out.fill(np.nan)
+        np.divide(num, den, out=out, where=den!=0)
+        out *= factor
+        return out
+
+    def linear_kernel(arr, factor, offset, out):
+        """
+            out = arr * factor + offset
+        """
+        np.multiply(arr, factor, out=out)
+        out += offset
+        return out
+
+    def balance_kernel(aeti, pcp, volume, out):
+        """
+            out = 1 - (aeti - pcp) / volume
+        """
+        np.subtract(aeti, pcp, out=out, dtype=out.dtype)
+        out /= -volume
+        out += 1.0
+        return out
+
+    def depleted_kernel(aeti, pcp, volume, out):
+        """
+            out = 1 - aeti / (pcp + volume), NaN where pcp + volume is 0.
+        """
+        np.add(pcp, volume, out=out)
+        zero = out == 0
+        np.divide(aeti, out, out=out, where=~zero)
+        np.subtract(1.0, out, out=out)
+        out[zero] = np.nan
+        return out
+
+    def stats_kernel(arr, mask):
+        """
+            Count, mean and sum of squared deviations from the mean (M2, in
+            float64) of the values of arr that are neither masked nor NaN.
+        """
+        vals = arr[~(mask | np.isnan(arr))]
+        if vals.size == 0:
+            return 0, 0.0, 0.0
+        mean = vals.mean(dtype=np.float64)
+        dev = vals - mean
+        return vals.size, mean, np.einsum('i,i->', dev, dev)
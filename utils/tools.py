@@ -1,8 +1,12 @@
 from qgis.gui import QgsMapTool, QgsRubberBand
-from qgis.core import QgsPointXY, QgsWkbTypes, QgsCoordinateReferenceSystem, QgsProject, QgsCoordinateTransform
-from qgis.PyQt.QtCore import Qt
+from qgis.core import QgsPointXY, QgsWkbTypes, QgsCoordinateReferenceSystem, QgsProject, QgsCoordinateTransform, QgsMessageLog, Qgis, QgsGeometry
+from qgis.PyQt.QtCore import Qt, QTimer, QElapsedTimer, pyqtSignal
 from qgis.PyQt.QtGui import QColor 
 
+import struct
+import weakref
+import numpy as np
+
 from .geometry import isValid
 
 class CoordinatesSelectorTool(QgsMapTool):   
@@ -14,52 +18,120 @@ class CoordinatesSelectorTool(QgsMapTool):
         Attributes
         ----------
         canvas : QgsCanvas
-            Canvas from which the coordinates will be selected.
+            Canvas from which the coordinates will be selected, only weakly
+            referenced by the tool.
         label : QtLabel
-            Label to comunicate events from the tool.
+            Label to comunicate events from the tool, only weakly referenced
+            by the tool.
         savePolygonButton : QtButton
             Button to coordinate the closure of the polygon.
         rubberBand : QgsRubberBand
             Entity to storage the coordinates and draw the resulting polygon in
             canvas.
+        polygonCoordinates : list
+            Coordinates [x, y] of the selected vertices, backed by a (N, 2)
+            float64 array that grows by doubling its capacity.
+        movePoint : QgsPointXY
+            Last map coordinate under the cursor, refreshed at most every
+            MOVE_INTERVAL milliseconds.
 
         Methods
         -------
 
     """
+    # Emitted with the map coordinates of every pressed point, the label is
+    # updated from a queued connection once the canvas has been repainted.
+    coordReady = pyqtSignal(float, float)
+
+    # Mouse move events are coalesced to ~60 Hz
+    MOVE_INTERVAL = 16
+
+    # The class does not declare __slots__: the sip wrapper of QgsMapTool
+    # already gives every instance a __dict__, so slots would not save memory,
+    # and 'canvas'/'label' are properties, which cannot also be slots.
+
     def __init__(self, canvas):
         QgsMapTool.__init__(self, canvas)
         
-        self.canvas = canvas    
+        self._canvasRef = weakref.ref(canvas)
+        self._labelRef = None
         # self.label = label    
         # self.savePolygonButton = savePolygonButton
 
-        self.rubberBand = QgsRubberBand(self.canvas, QgsWkbTypes.PolygonGeometry )
+        self.rubberBand = QgsRubberBand(canvas, QgsWkbTypes.PolygonGeometry )
         self.rubberBand.setColor(Qt.red)
         self.rubberBand.setFillColor(QColor(0,255,0,0))
         self.rubberBand.setWidth(1)
+
+        self._debug = False
+        self.movePoint = None
+        self._coordTransform = None
+        self._affine = None
+        self._pendingMoveEvent = None
+        self._updatePending = False
+        self._moveGate = QElapsedTimer()
+        self._moveGate.start()
+        self.coordReady.connect(self._updateLabel, Qt.QueuedConnection)
         self.reset()
 
+    @property
+    def canvas(self):
+        """
+            Returns the canvas of the tool without keeping it alive. If the
+            Python wrapper was collected the canvas is asked to the base class.
+        """
+        canvas = self._canvasRef()
+        if canvas is None:
+            canvas = QgsMapTool.canvas(self)
+        return canvas
+
+    @property
+    def label(self):
+        """
+            Returns the label used to comunicate events, None if it was deleted.
+        """
+        return self._labelRef() if self._labelRef is not None else None
+
+    @label.setter
+    def label(self, label):
+        self._labelRef = weakref.ref(label)
+
     def reset(self):
         """
             Resets the coordinates storaged by the tool and clean the canvas.
         """
-        self.rubberCoordinates = list()
-        self.polygonCoordinates = list()
+        self._xy = np.empty((16, 2), dtype=np.float64)
+        self._nPoints = 0
+        self._rubberClosed = False
+        self._lastPos = None
+        self._rubberShown = False
 
-        self.rubberBand.reset()
+        self.updateShape()
+
+    @property
+    def polygonCoordinates(self):
+        """
+            Returns the selected vertices as a list of [x, y] pairs.
+        """
+        return self._xy[:self._nPoints].tolist()
+
+    def _appendCoordinate(self, x, y):
+        """
+            Stores a vertex in the coordinates buffer, doubling its capacity
+            when it is full.
+        """
+        if self._nPoints == self._xy.shape[0]:
+            self._xy = np.concatenate((self._xy, np.empty_like(self._xy)))
+        self._xy[self._nPoints] = (x, y)
+        self._nPoints += 1
     
-    def updateShape(self):
+    def _showRubberBand(self):
         """
-            Updates the coordinates storaged by the tool and refreshes the canvas.
+            Shows the rubber band the first time it holds a point after a reset.
         """
-        self.rubberBand.reset()
-        for idx, point in enumerate(self.rubberCoordinates):
-            if idx != len(self.rubberCoordinates)-1:
-                self.rubberBand.addPoint(QgsPointXY(point.x(), point.y()), False)
-            else:
-                self.rubberBand.addPoint(QgsPointXY(point.x(), point.y()), True) # true to update canvas
-        self.rubberBand.show()
+        if not self._rubberShown:
+            self.rubberBand.show()
+            self._rubberShown = True
 
     def canvasPressEvent(self, event):
         """
@@ -70,22 +142,45 @@ class CoordinatesSelectorTool(QgsMapTool):
             event : PressEvent
                 Holds the information associated to the press event over the canvas.
         """
-        x = float(self.toMapCoordinates(event.pos()).x())
-        y = float(self.toMapCoordinates(event.pos()).y())
-        self.label.setText('x:{} || y:{}'.format(x,y))
+        pos = event.pos()
+        point = self._toMapCoordinates(pos.x(), pos.y())
+        x = point.x()
+        y = point.y()
+        self.coordReady.emit(x, y)
 
-        self.rubberCoordinates.append(self.toMapCoordinates(event.pos()))
-        self.polygonCoordinates.append([x,y])
+        self._appendCoordinate(x, y)
 
-        if not self.savePolygonButton.isEnabled() and len(self.rubberCoordinates) > 2:
+        if not self.savePolygonButton.isEnabled() and self._nPoints > 2:
             self.savePolygonButton.setEnabled(True)
 
-        print(self.rubberCoordinates)
-        print(self.polygonCoordinates)
+        if __debug__ and self._debug:
+            QgsMessageLog.logMessage('Vertex added: {}'.format([x,y]), 'WAPlugin', Qgis.Info)
 
-        self.updateShape()
+        # The canvas is refreshed once the pending events are processed, a
+        # burst of clicks costs a single repaint.
+        self.rubberBand.addPoint(point, False)
+        if not self._updatePending:
+            self._updatePending = True
+            QTimer.singleShot(0, self._doUpdate)
 
+    def _doUpdate(self):
+        """
+            Refreshes the rubber band after the vertices added by
+            canvasPressEvent.
+        """
+        self._updatePending = False
+        self.rubberBand.updatePosition()
+        self.rubberBand.update()
+        self._showRubberBand()
         
+    def _updateLabel(self, x, y):
+        """
+            Shows the coordinates of the last pressed point in the label.
+        """
+        label = self.label
+        if label is not None:
+            label.setText(f'x:{x} || y:{y}')
+
     def canvasMoveEvent(self, event):
         """
             Captures the move events held on the canvas.
@@ -95,9 +190,30 @@ class CoordinatesSelectorTool(QgsMapTool):
             event : MoveEvent
                 Holds the information associated to the move event over the canvas.
         """
-        x = event.pos().x()
-        y = event.pos().y()
-        point = self.canvas.getCoordinateTransform().toMapCoordinates(x, y)
+        pos = event.pos()
+        lastPos = self._lastPos
+        if lastPos is not None and abs(pos.x() - lastPos.x()) + abs(pos.y() - lastPos.y()) < 1:
+            return
+        self._lastPos = pos
+
+        # Events arriving less than MOVE_INTERVAL after the last processed one
+        # are only recorded, canvasReleaseEvent flushes the last of them.
+        self._pendingMoveEvent = pos
+        if self._moveGate.elapsed() < self.MOVE_INTERVAL:
+            return
+        self._moveGate.restart()
+        self._processMoveEvent()
+
+    def _processMoveEvent(self):
+        """
+            Converts the last position received by canvasMoveEvent to map
+            coordinates.
+        """
+        if self._pendingMoveEvent is None:
+            return
+        pos = self._pendingMoveEvent
+        self._pendingMoveEvent = None
+        self.movePoint = self._toMapCoordinates(pos.x(), pos.y())
 
     def canvasReleaseEvent(self, event):
         """
@@ -108,23 +224,60 @@ class CoordinatesSelectorTool(QgsMapTool):
             event : ReleaseEvent
                 Holds the information associated to the release event over the canvas.
         """
-        x = event.pos().x()
-        y = event.pos().y()
-
-        point = self.canvas.getCoordinateTransform().toMapCoordinates(x, y)
+        self._processMoveEvent()
 
     def activate(self):
         """
             Code to execute when the tool is activated.
         """
         self.setCursor(Qt.CrossCursor)
+        canvas = self.canvas
+        if canvas is None:
+            return
+        self._refreshTransform()
+        canvas.extentsChanged.connect(self._refreshTransform)
+        canvas.destinationCrsChanged.connect(self._refreshTransform)
         self.reset()
 
     def deactivate(self):
         """
             Code to execute when the tool is deactivated.
         """
-        pass
+        self._pendingMoveEvent = None
+        canvas = self.canvas
+        if canvas is None:
+            return
+        try:
+            canvas.extentsChanged.disconnect(self._refreshTransform)
+            canvas.destinationCrsChanged.disconnect(self._refreshTransform)
+        except TypeError:
+            # The tool was never activated, nothing to disconnect
+            pass
+
+    def _refreshTransform(self):
+        """
+            Caches the pixel to map transform of the canvas, it is refreshed
+            every time the extent or the CRS of the canvas change.
+        """
+        self._coordTransform = self.canvas.getCoordinateTransform()
+
+        # Without rotation the transform is a plain scale and translation,
+        # keep its coefficients to convert pixels without calling into C++.
+        if self._coordTransform.mapRotation() == 0:
+            origin = self._coordTransform.toMapCoordinates(0, 0)
+            self._affine = (origin.x(), origin.y(), self._coordTransform.mapUnitsPerPixel())
+        else:
+            self._affine = None
+
+    def _toMapCoordinates(self, x, y):
+        """
+            Converts a pixel position of the canvas to map coordinates using the
+            cached transform.
+        """
+        if self._affine is None:
+            return self._coordTransform.toMapCoordinates(x, y)
+        xOrigin, yOrigin, mupp = self._affine
+        return QgsPointXY(xOrigin + x * mupp, yOrigin - y * mupp)
 
     def getCoordinatesBuffer(self):
         """
@@ -132,19 +285,58 @@ class CoordinatesSelectorTool(QgsMapTool):
             with the coordinated gathered by the tool if the resulting polygon
             is valid.
         """
-        self.rubberBand.closePoints(True)
+        # Closing the rubber band repaints the canvas, it is deferred so the
+        # caller can start working with the buffer first.
+        if not self._rubberClosed:
+            self._rubberClosed = True
+            QTimer.singleShot(0, self.updateShape)
         # polygon = Polygon(self.polygonCoordinates)
         # if polygon.is_valid:
-        if isValid(self.polygonCoordinates):
-            print('Poligon validity check manually: ', True)
-            self.label.setText('{} vertex sel.'.format(len(self.polygonCoordinates)))
-            self.polygonCoordinates.append(self.polygonCoordinates[0])
-            return self.polygonCoordinates
+        polygonCoordinates = self.polygonCoordinates
+        valid = isValid(polygonCoordinates)
+        if __debug__ and self._debug:
+            QgsMessageLog.logMessage('Polygon validity check: {}'.format(valid), 'WAPlugin', Qgis.Info)
+        if valid:
+            if self.label is not None:
+                self.label.setText('{} vertex sel.'.format(len(polygonCoordinates)))
+            if polygonCoordinates[0] != polygonCoordinates[-1]:
+                polygonCoordinates.append(polygonCoordinates[0])
+            return polygonCoordinates
         else:
-            print('Poligon validity check manually: ', False)
-            self.label.setText('Shape not valid')
+            if self.label is not None:
+                self.label.setText('Shape not valid')
             return None
         
+    def updateShape(self):
+        """
+            Rebuilds the rubber band from the stored vertices in a single
+            geometry update. Used when the vertices change as a whole (reset,
+            closing the polygon), canvasPressEvent only appends the new vertex.
+        """
+        if self._nPoints == 0:
+            geometry = None
+        else:
+            # The closed ring is written as WKB (little endian Polygon, type 3,
+            # one ring) straight from the buffer, no QgsPointXY per vertex.
+            xy = self._xy[:self._nPoints]
+            ring = np.concatenate((xy, xy[:1])).astype('<f8')
+            geometry = QgsGeometry()
+            geometry.fromWkb(struct.pack('<BIII', 1, 3, 1, ring.shape[0]) + ring.tobytes())
+
+        # setToGeometry resets the band and then adds the geometry, each step
+        # schedules a repaint: the canvas repaints once when updates resume.
+        canvas = self.canvas
+        if canvas is not None:
+            canvas.setUpdatesEnabled(False)
+        try:
+            if geometry is None:
+                self.rubberBand.reset(QgsWkbTypes.PolygonGeometry)
+            else:
+                self.rubberBand.setToGeometry(geometry, None)
+        finally:
+            if canvas is not None:
+                canvas.setUpdatesEnabled(True)
+
     def isZoomTool(self):
         return False
 
@@ -49,7 +49,7 @@ from .utils.wapordl_ext import wapor_map
 
 try:
     from .utils.managers import Wapor2APIManager, Wapor3APIManager, FileManager, CanvasManager
-    from .utils.indicators import IndicatorCalculator, INDICATORS_INFO
+    from .utils.indicators import IndicatorCalculator, INDICATORS
     from .utils.tools import CoordinatesSelectorTool
 
 except ModuleNotFoundError as e:
@@ -570,41 +570,42 @@ class WAPlugin:
         """
         self.indicator_key = self.dlg.indicatorListComboBox.currentText()
         self.dlg.indicInfoLabel.setWordWrap(True)
+        indicator = INDICATORS[self.indicator_key]
         
         """ Update Indicator Info """
-        raster_info = [INDICATORS_INFO[self.indicator_key]['info'] + '\n']
+        raster_info = [indicator.info + '\n']
         raster_info.extend(['==' * 20 + '\n'])
-        raster_info.extend([raster + ': ' + INDICATORS_INFO[self.indicator_key]['rasters'][raster] + '\n'
-                    for raster in INDICATORS_INFO[self.indicator_key]['rasters']])
+        raster_info.extend([raster + ': ' + name + '\n'
+                    for raster, name in indicator.rasters])
         raster_info.extend(['--' * 20 + '\n'])
-        raster_info.extend([factor + ': ' + INDICATORS_INFO[self.indicator_key]['factors'][factor] + '\n'
-                            for factor in INDICATORS_INFO[self.indicator_key]['factors']])
+        raster_info.extend([factor + ': ' + description + '\n'
+                            for factor, description in indicator.factors])
         
         """ Raster Files Filtered Update """
         self.listRasterCalcMemory()
 
         """ Parameters Update """
-        if INDICATORS_INFO[self.indicator_key]['params']['PARAM_1'] == '':
+        if indicator.params[0] is None:
             self.dlg.Param1Label.setText('Not Required')
             self.dlg.Param1ComboBox.setEnabled(False)
         else:
-            self.dlg.Param1Label.setText(INDICATORS_INFO[self.indicator_key]['params']['PARAM_1']['label'])
-            filteredRasterFiles = self.file_manag.filterRasterFiles(self.tif_calc_files, INDICATORS_INFO[self.indicator_key]['params']['PARAM_1']['type'])
+            self.dlg.Param1Label.setText(indicator.params[0].label)
+            filteredRasterFiles = self.file_manag.filterRasterFiles(self.tif_calc_files, indicator.params[0].type)
             self.dlg.Param1ComboBox.clear()
             self.dlg.Param1ComboBox.addItems(filteredRasterFiles.keys())
             self.dlg.Param1ComboBox.setEnabled(True)
 
-        if INDICATORS_INFO[self.indicator_key]['params']['PARAM_2'] == '':
+        if indicator.params[1] is None:
             self.dlg.Param2Label.setText('Not Required')
             self.dlg.Param2ComboBox.setEnabled(False)
         else:
-            self.dlg.Param2Label.setText(INDICATORS_INFO[self.indicator_key]['params']['PARAM_2']['label'])
-            filteredRasterFiles = self.file_manag.filterRasterFiles(self.tif_calc_files, INDICATORS_INFO[self.indicator_key]['params']['PARAM_2']['type'])
+            self.dlg.Param2Label.setText(indicator.params[1].label)
+            filteredRasterFiles = self.file_manag.filterRasterFiles(self.tif_calc_files, indicator.params[1].type)
             self.dlg.Param2ComboBox.clear()
             self.dlg.Param2ComboBox.addItems(filteredRasterFiles.keys())
             self.dlg.Param2ComboBox.setEnabled(True)
 
-        if INDICATORS_INFO[self.indicator_key]['params']['PARAM_3'] == '':
+        if not indicator.params[2]:
             self.dlg.Param3Label.setText('Not Required')
             self.dlg.Param3TextBox.setText("")
             self.dlg.Param3TextBox_2.setText("")
@@ -621,7 +622,7 @@ class WAPlugin:
         else:
             self.dlg.Param3Label.setText('Other Parameters')
             param_list = [self.dlg.Param3TextBox, self.dlg.Param3TextBox_2, self.dlg.Param3TextBox_3, self.dlg.Param3TextBox_4]
-            for i, param in enumerate(INDICATORS_INFO[self.indicator_key]['params']['PARAM_3']):
+            for i, param in enumerate(indicator.params[2]):
                 param_list[i].setPlaceholderText(param)
                 param_list[i].setEnabled(True)
             """ Old code below. Kept for referense """
@@ -1276,7 +1277,7 @@ class WAPlugin:
 
             self.prev_tool = self.iface.mapCanvas().mapTool()
 
-            self.dlg.indicatorListComboBox.addItems(INDICATORS_INFO.keys())
+            self.dlg.indicatorListComboBox.addItems(INDICATORS.keys())
 
             self.coord_select_tool = CoordinatesSelectorTool(self.iface.mapCanvas())
 